@@ -41,6 +41,7 @@ To create an EC2 instance, create a ``yaml`` file with the following format:
        data: 10 (default: none)
        srcdstchk: True|False (defaults to False)
        pubip: True|False (defaults to False)
+       userdata_format: raw|multipart|gzip (defaults to raw)
        elb:
          scheme: internal|internet-facing
          elb_proto: tcp|udp
@@ -54,6 +55,9 @@ To create an EC2 instance, create a ``yaml`` file with the following format:
     * name should be of the form customer-service-number
     * AZ must exist and have the form: title-az[ab]
     * if no proto / ports are given to ``elb``, it will assume TCP/80
+    * ``multipart`` userdata is a cloud-init MIME multipart, starting a new
+      part with every file beginning with a cloud-init header like ``#!`` or
+      ``#cloud-config``, ``gzip`` compresses it to fit EC2 16KB limit
 
 To create an RDS instance, create a ``yaml`` file with the following format:
 
@@ -105,16 +109,21 @@ To create an RDS instance, create a ``yaml`` file with the following format:
 import os
 import sys
 import yaml
-import time
 import string
 import random
+import threading
+from multiprocessing.pool import ThreadPool
 from subprocess import call
 from prettytable import from_csv
 
 sys.path.append(os.getcwd())
 
 import mods.awsprice as ap
-from mods.session import Aws
+import mods.cost as cost
+from mods.session import Aws, TagBatch, WaiterTimeout, waiter, profiles
+from mods.scheduler import Scheduler, prompt
+from mods.journal import Journal
+from mods.topology import Topology
 # custom module you'd want to import
 try:
     import mods.external as ext
@@ -132,31 +141,161 @@ if profile is None:
     print "Please add a profile or set the EC2REGION environment variable."
     sys.exit(1)
 
-ec2 = Aws(profile, 'ec2')
+class Context(object):
+    '''Lazily built working context
+
+    The ``boto3`` session, EC2 client / resource and default VPC are only
+    created the first time a subcommand needs them, so offline commands like
+    ``lsyaml`` start instantly and never talk to AWS.
+
+    :param str profile: Region profile, as defined in awscli configuration
+    '''
+    def __init__(self, profile):
+        self.profile = profile
+        self._services = {}
+        self._lock = threading.RLock()
+        self._vpc = None
+        self._topology = None
+
+    def service(self, t):
+        '''``Aws`` object for a service, created on first access
+
+        :param str t: Service name, like ``elb`` or ``rds``
+        '''
+        with self._lock:
+            if t not in self._services:
+                self._services[t] = Aws(self.profile, t)
+            return self._services[t]
+
+    @property
+    def ec2(self):
+        '''``Aws`` EC2 object, created on first access
+        '''
+        return self.service('ec2')
+
+    @property
+    def topology(self):
+        '''Region network ``Topology`` snapshot, loaded on first access
+        '''
+        with self._lock:
+            if self._topology is None:
+                self._topology = Topology(self.ec2)
+            return self._topology
+
+    @property
+    def vpc(self):
+        '''Default VPC, looked up on first access
+        '''
+        # by default, work on the 1st VPC
+        if self._vpc is None:
+            for v in self.ec2.resource.vpcs.all():
+                self._vpc = v
+                break
+        return self._vpc
+
+    @vpc.setter
+    def vpc(self, vpc):
+        self._vpc = vpc
+
+ctx = Context(profile)
 
 print "> working on profile: {0}".format(profile)
 
-# by default, work on the 1st VPC
-vpc = [v for v in ec2.resource.vpcs.all()][0]
+# ls shortcuts to describe_instances filter names
+lsfilters = {
+    'state': 'instance-state-name',
+    'type': 'instance-type',
+    'name': 'tag:Name',
+    'az': 'availability-zone',
+}
+
+def _mkfilters(args):
+    '''Converts ``key=value[,value...]`` arguments to ``describe`` filters
+
+    :param list args: Command line arguments, like ``state=running``
+
+    :return: Filter list
+    :rtype: list
+    '''
+    filters = []
+    for arg in args:
+        if not '=' in arg:
+            print('invalid filter {0}, expecting key=value'.format(arg))
+            sys.exit(1)
+        k, v = arg.split('=', 1)
+        filters.append({
+            'Name': lsfilters.get(k, k), 'Values': v.split(',')
+        })
+    return filters
 
 def ls():
     '''List instances running in current region
+
+    Optional filters can be given as ``key=value[,value...]`` arguments, with
+    ``key`` being ``state``, ``type``, ``name``, ``az``, ``tag:<Key>`` or any
+    ``describe_instances`` filter name, i.e.::
+
+        ec2.py ls state=running tag:Customer=foo type=t2.micro,t2.small
     '''
-    for i in ec2.getall('instances'):
-        if i.tags is None:
-            print("/!\ {0} has no tag name [{1}]".format(i.id, i.state['Name']))
-            continue
+    ec2 = ctx.ec2
+    for page in ec2.iterpages(_mkfilters(sys.argv[2:])):
+        for i in page:
+            if i['tags'] is None:
+                print("/!\ {0} has no tag name [{1}]".format(
+                    i['id'], i['state']
+                ))
+                continue
 
-        t = ec2.tags2dict(i.tags)
-        tid = i.id
+            t = i['tags']
+            tid = i['id']
 
-        if ext_available is True:
-            idtag = ext.custom_idtag
-            tid = i.id if not idtag in t else t[idtag]
+            if ext_available is True:
+                idtag = ext.custom_idtag
+                tid = i['id'] if not idtag in t else t[idtag]
 
-        print "{0} {1} ({2}) - [{3}]".format(
-            tid, t['Name'], i.instance_type, i.state['Name']
-        )
+            print "{0} {1} ({2}) - [{3}]".format(
+                tid, t.get('Name'), i['type'], i['state']
+            )
+        # show results as they come
+        sys.stdout.flush()
+
+def dmesg():
+    '''Show instances console output
+
+    Instances are given by ``id`` or Name tag, with optional wildcards. When
+    many instances match, their console outputs are fetched concurrently on
+    ``EC2JOBS`` workers (defaults to 8) and printed as they arrive, each line
+    prefixed by the instance Name, i.e.::
+
+        ec2.py dmesg i-0123456789abcdef0
+        ec2.py dmesg 'foo-www-*' | grep -i error
+    '''
+    if len(sys.argv) < 3:
+        print('usage: {0} {1} <id|name> ...'.format(sys.argv[0], dmesg.__name__))
+        sys.exit(1)
+
+    ec2 = ctx.ec2
+    instances = {}
+    for name in sys.argv[2:]:
+        for i in ec2.findinstances(name):
+            instances[i['id']] = i
+    instances = sorted(instances.values(), key = lambda i: i['id'])
+
+    if not instances:
+        print('no instance matching {0}'.format(' '.join(sys.argv[2:])))
+        sys.exit(1)
+
+    if len(instances) == 1:
+        print(ec2.console(instances[0]['id']))
+        return
+
+    jobs = int(os.environ.get('EC2JOBS', 8))
+    for i, output in ec2.dmesgs(instances, jobs):
+        tags = i['tags'] or {}
+        prefix = '{0} {1}'.format(tags.get('Name', '-'), i['id'])
+        for line in output.splitlines():
+            print('{0}: {1}'.format(prefix, line.encode('utf-8')))
+        sys.stdout.flush()
 
 def getyaml(fn, yf):
     '''Read infrastructure ``yaml`` description
@@ -178,70 +317,58 @@ def getyaml(fn, yf):
 
     return y
 
-def wait4tag(res, tag, val):
-    '''Waits for resource to be available before tagging its name
+def _natname(instance):
+    '''Returns the Name tag of the NAT instance serving an instance
+    '''
+    if ext_available is True:
+        return ext.natinstancename(instance)
+    return 'nat-instance'  # warning, this is an example
 
-    :param str res: Resource name
-    :param str tag: Tag key to be given
-    :param str val: Tag value to be given
+def _rtname(instance):
+    '''Returns the Name tag of the route table of an instance subnets
     '''
-    rise = False
-    while rise is False:
-        try:
-            ec2.create_tag(res.id, tag, val)
-            rise = True
-        except:
-            e = sys.exc_info()[1]
-            print('waiting for resource to rise, {0}'.format(e))
-            time.sleep(1)
+    if instance['type'].startswith('db.'):
+        return '{0}-rdsRT'.format(instance['customer'])
+    return '{0}-ec2RT'.format(instance['customer'])
 
-def subnet_check(ec2, subname, instance):
+def subnet_check(ctx, subname, instance):
     '''Checks subnet existence for a given instance IP address and create it
     if not available
 
-    :param ec2: EC2 resource
+    Every check is answered by the region topology snapshot, which records
+    created resources.
+
+    :param ctx: Region context
     :param str subnet: subnet name
     :param dict instance: Instance informations
     '''
+    ec2 = ctx.ec2
+    topo = ctx.topology
     myaz = subname[-1]
 
-    if ec2.get_obj_from_nametag('subnets', subname):
+    if topo.subnet(subname):
         print('{0} already available, continuing'.format(subname))
         return
 
-    if ext_available is True:
-        niname = ext.natinstancename(instance)
-    else:
-        niname = 'nat-instance'  # warning, this is an example
-
-    natinstance = [
-            i for i in ec2.resource.instances.filter(
-                Filters = [{'Name': 'tag:Name', 'Values': [niname]}]
-            )
-    ]
-
+    vpc = ctx.vpc
     vpcid = vpc.id
 
-    if not natinstance:
+    natid = topo.nat(_natname(instance))
+    if natid is None:
         print('NO NAT instance for customer {0}'.format(instance['customer']))
-        reply = raw_input('attach this network to an Internet gw? [y/N] ')
+        reply = prompt('attach this network to an Internet gw? [y/N] ')
         if reply[0] != 'y':
             sys.exit(1)
-        gwid = [i for i in vpc.internet_gateways.all()][0].id
+        gwid = topo.igw(vpcid)
+        if gwid is None:
+            print('no Internet gw attached to {0}, aborting'.format(vpcid))
+            sys.exit(1)
         nat = False
     else:
-        gwid = natinstance[0].id
+        gwid = natid
         nat = True
 
-    zone = None
-
-    azs = ec2.client.describe_availability_zones()
-    for raz in azs['AvailabilityZones']:
-        # us-east-1[a] == az[a]
-        if raz['ZoneName'][-1] == myaz:
-            zone = raz['ZoneName']
-            break
-
+    zone = topo.az(myaz)
     if zone is None:
         print('{0} does not match any AZ, aborting'.format(myaz))
         sys.exit(1)
@@ -253,76 +380,95 @@ def subnet_check(ec2, subname, instance):
     else:
         cidr = instance['subnets']['az{0}'.format(myaz)]
 
+    owner = topo.cidr_owner(cidr, vpcid)
+    if owner is not None:
+        print('{0} is already used by {1}, aborting'.format(cidr, owner))
+        sys.exit(1)
+
     # create the subnet
-    rs = ec2.resource.create_subnet(
+    rs = ec2.client.create_subnet(
         DryRun = False,
         VpcId = vpcid,
         CidrBlock = cidr,
-        AvailabilityZone = zone
-    )
-    wait4tag(rs, 'Name', subname)
-    print('created subnet {0}'.format(rs.id))
+        AvailabilityZone = zone,
+        TagSpecifications = [ec2.tagspec('subnet', {'Name': subname})]
+    )['Subnet']
+    subnetid = rs['SubnetId']
+    topo.add_subnet(rs)
+    ec2.remember_nametag('subnets', subname, subnetid)
+    print('created subnet {0}'.format(subnetid))
 
     # create a route table
-    if instance['type'].startswith('db.'):
-        rtname = '{0}-rdsRT'.format(instance['customer'])
-    else:
-        rtname = '{0}-ec2RT'.format(instance['customer'])
+    rtname = _rtname(instance)
 
-    rt = ec2.get_obj_from_nametag('route_tables', rtname)
-    if rt:
-        rt_exists = True
+    rtid = topo.route_table(rtname)
+    if rtid:
         print('{0} already exists, continuing'.format(rtname))
     else:
-        rt_exists = False
-
-    # create route table if non existent
-    if rt_exists is False:
-        rt = ec2.resource.create_route_table(
+        # create route table if non existent
+        rt = ec2.client.create_route_table(
             DryRun = False,
-            VpcId = vpcid
-        )
-
-        wait4tag(rt, 'Name', rtname)
-        print('created route table {0}'.format(rt.id))
+            VpcId = vpcid,
+            TagSpecifications = [ec2.tagspec('route-table', {'Name': rtname})]
+        )['RouteTable']
+        rtid = rt['RouteTableId']
+        topo.add_route_table(rt)
+        ec2.remember_nametag('route_tables', rtname, rtid)
+        print('created route table {0}'.format(rtid))
 
     # associate route table and subnet
-    rta = rt.associate_with_subnet(
+    rta = ec2.client.associate_route_table(
         DryRun = False,
-        SubnetId = rs.id
+        RouteTableId = rtid,
+        SubnetId = subnetid
     )
-    print('associated route table {0} with {1}'.format(rt.id, rta.id))
-    # create the default route
-    kwargs = {'DryRun': False, 'DestinationCidrBlock': '0.0.0.0/0',}
+    topo.associate(rtid, subnetid)
+    print('associated route table {0} with {1}'.format(
+        rtid, rta['AssociationId']
+    ))
+
+    # create the default route, unless the route table is shared and has it
+    if topo.has_route(rtid, '0.0.0.0/0'):
+        return
+
+    kwargs = {
+        'DryRun': False,
+        'RouteTableId': rtid,
+        'DestinationCidrBlock': '0.0.0.0/0',
+    }
     if nat is True:
         kwargs['InstanceId'] = gwid
     else:
         # subnet has a default route to IGW, we must propagate routes from VGW
         kwargs['GatewayId'] = gwid
-        vgw = ec2.client.describe_vpn_gateways()
-        for v in vgw['VpnGateways']:
-            if v['VpcAttachments']:
-                vgwid = v['VpnGatewayId']
-                break
-        print('attaching route table {0} to vgw {1}'.format(rt.id, vgwid))
-        ec2.client.enable_vgw_route_propagation(
-            RouteTableId = rt.id,
-            GatewayId = vgwid
-        )
+        vgwid = topo.vgw(vpcid)
+        if vgwid is None:
+            print('no vgw attached to {0}, not propagating'.format(vpcid))
+        elif not topo.propagates(rtid, vgwid):
+            print('attaching route table {0} to vgw {1}'.format(rtid, vgwid))
+            ec2.client.enable_vgw_route_propagation(
+                RouteTableId = rtid,
+                GatewayId = vgwid
+            )
+            topo.add_propagation(rtid, vgwid)
 
-    rc = rt.create_route(**kwargs)
+    ec2.client.create_route(**kwargs)
+    topo.add_route(rtid, '0.0.0.0/0')
 
 def _mkdefval(data, kw, default):
     return default if not kw in data else data[kw]
 
-def elb_register(ec2, allaz, curaz, instance):
+def elb_register(ctx, allaz, curaz, instance, persist = None):
     '''Register an instance to an ELB, creating the latter if it does not exist
 
+    :param ctx: Region context
     :param dict allaz: Every AZ present in the region, from the YAML file
     :param str curaz: Current AZ, where the current instance is being created
     :param dict instance: Instance being processed
+    :param persist: Optional callable recording ``instance`` new state
     '''
-    elb = Aws(ec2.profile, 'elb')
+    ec2 = ctx.ec2
+    elb = ctx.service('elb')
 
     elbs = elb.client.describe_load_balancers()
 
@@ -344,7 +490,7 @@ def elb_register(ec2, allaz, curaz, instance):
                 # take 1st IP address from that subnet / AZ
                 ipaddr = availz[yaz][0]['ipaddr']
                 # and check for subnet existence
-                subnet_check(ec2, yaz, instance)
+                subnet_check(ctx, yaz, instance)
                 # and add it to subnet_ids
                 subnet_ids.append(ec2.get_id_from_nametag('subnets', yaz))
 
@@ -376,14 +522,17 @@ def elb_register(ec2, allaz, curaz, instance):
             'InstanceId': instance['awsid']
         }]
     )
+    if persist is not None:
+        persist(instance, {'awselb': lbname})
 
 chars = ''.join([string.letters, string.digits])
 
-def create_rds(ec2, subname, instance):
+def create_rds(ctx, subname, instance):
     '''Create RDS instance described in the ``yaml`` file passed in parameter
     '''
 
-    rds = Aws(ec2.profile, 'rds')
+    ec2 = ctx.ec2
+    rds = ctx.service('rds')
 
     pwd = ''.join((random.choice(chars)) for x in range(20))
 
@@ -392,7 +541,7 @@ def create_rds(ec2, subname, instance):
     for s in instance['subnets']:
         azname = '{0}-{1}'.format(subname, s)
         subnames.append(azname)
-        subnet_check(ec2, azname, instance)
+        subnet_check(ctx, azname, instance)
 
     subnetids = [
         ec2.get_id_from_nametag('subnets', s) for s in subnames
@@ -419,7 +568,7 @@ def create_rds(ec2, subname, instance):
 
     sg = []
     for rule in instance['sg']:
-        sg.append(ec2.mksg(vpc, rule).id)
+        sg.append(ec2.mksg(ctx.vpc, rule).id)
 
     kwargs = {
         'DBInstanceIdentifier': instance['name'],
@@ -452,19 +601,228 @@ def create_rds(ec2, subname, instance):
 
 # Parse YAML and create EC2 instances
 
+def _launch(ctx, reg, az, instance, persist):
+    '''Launch and tag a single EC2 instance
+
+    :param ctx: Region context
+    :param str reg: Region profile, as found in the ``yaml`` file
+    :param str az: Subnet / AZ name the instance lives in
+    :param dict instance: Instance informations
+    :param persist: Callable recording ``instance`` new state
+    '''
+    ec2 = ctx.ec2
+    ec2r = ec2.resource
+
+    if 'debian' in instance['image']:
+        image = ec2.get_debian_ami(instance['image'])
+    else:
+        image = ec2.getami(instance['image'])
+    sg = []
+    for sglist in instance['sg']:
+        sg.append(ec2.get_id_from_nametag(
+            'security_groups', sglist
+        ))
+    subnet = ec2.get_id_from_nametag('subnets', az)
+
+    if 'data' in instance:
+        blockdevmap = [
+            {
+                'DeviceName': '/dev/xvdb',
+                'Ebs': {
+                    'VolumeSize': instance['data'],
+                    'DeleteOnTermination': True,
+                }
+            }
+        ]
+    else:
+        blockdevmap = []
+
+    if 'pubip' in instance and instance['pubip'] is True:
+        pubip = True
+    else:
+        pubip = False
+
+    # Here, 'name' is the tag Name
+
+    # netblock for a NAT-type instance
+    netblock = '{0}.0.0/16'.format(
+        '.'.join(instance['ipaddr'].split('.')[:2])
+    )
+
+    tags = ['name', 'customer']
+    # add custom fields
+    if ext_available is True:
+        newtags = ext.addfields(reg, instance)
+        if newtags:
+            tags.extend(newtags)
+    # instance and its volumes are tagged on creation
+    tagspecs = [
+        ec2.tagspec('instance', dict((t.title(), instance[t]) for t in tags))
+    ]
+    if blockdevmap:
+        tagspecs.append(
+            ec2.tagspec('volume', {'Customer': instance['customer']})
+        )
+
+    print("creating instance {0}".format(instance['name']))
+    rc = ec2r.create_instances(
+        ImageId = image,
+        MinCount = 1,
+        MaxCount = 1,
+        KeyName = instance['key'],
+        InstanceType = instance['type'],
+        BlockDeviceMappings = blockdevmap,
+        NetworkInterfaces = [{
+            'DeviceIndex': 0,
+            'Groups': sg,
+            'SubnetId': subnet,
+            'PrivateIpAddress': instance['ipaddr'],
+            'DeleteOnTermination': True,
+            'AssociatePublicIpAddress': pubip
+        }],
+        TagSpecifications = tagspecs,
+        UserData = ec2.mkuserdata(
+            b64 = False,
+            userdata = instance['userdata'],
+            name = instance['name'],
+            netblock = netblock,
+            fmt = instance.get('userdata_format', 'raw')
+        )
+    )
+
+    iid = rc[0].id
+    print("created instance {0} as {1}".format(instance['name'], iid))
+
+    persist(instance, {'awsid': iid, 'awssubnet': subnet})
+
+    # Mostly for NAT instances
+    if 'srcdstchk' in instance:
+        waiter(ec2r.Instance(iid).modify_attribute, kwargs = {
+            'SourceDestCheck': {
+                'Value': instance['srcdstchk']
+            }
+        })
+
+    # optionally do something with instance informations
+    # like inserting it to your own information system
+    if ext_available is True:
+        ext.instance_actions(ec2, reg, az, instance)
+
+def _tag_volumes(ctx, instances, persist):
+    '''Tag block devices attached to freshly created instances
+
+    Volumes of every instance are discovered with paginated, filtered
+    describe calls, then tagged through a ``TagBatch``. Their ``Name`` is
+    unique, so that is one ``CreateTags`` call per volume. Instances whose
+    block devices do not show up in time are reported once the others are
+    tagged.
+
+    :param ctx: Region context
+    :param list instances: Instances informations, with their ``awsid``
+    :param persist: Callable recording instances new state
+    '''
+    ec2 = ctx.ec2
+    byid = dict((i['awsid'], i) for i in instances)
+    ids = sorted(byid)
+    devices = {}
+
+    def _devices():
+        # filters, unlike InstanceIds, don't fail on a not yet visible id
+        for n in range(0, len(ids), 200):
+            pages = ec2.client.get_paginator('describe_instances').paginate(
+                Filters = [{'Name': 'instance-id', 'Values': ids[n:n + 200]}]
+            )
+            for page in pages:
+                for r in page['Reservations']:
+                    for i in r['Instances']:
+                        if i.get('BlockDeviceMappings'):
+                            devices[i['InstanceId']] = i['BlockDeviceMappings']
+        return devices
+
+    print("waiting for block devices to rise")
+    try:
+        waiter(_devices, until = lambda d: all(iid in d for iid in byid))
+    except WaiterTimeout:
+        pass
+
+    # Customer tag was given on creation, only the Name differs per volume
+    batch = TagBatch(ec2)
+    count = 0
+    for iid in sorted(devices):
+        volumes = {}
+        for dev in devices[iid]:
+            dname = dev['DeviceName'][5:]
+            print(
+                "tagging volume {0} to {1}_{2}".format(
+                    dev['Ebs']['VolumeId'],
+                    dname,
+                    byid[iid]['name']
+                )
+            )
+            batch.add(dev['Ebs']['VolumeId'], {
+                'Name': '{0}_{1}'.format(
+                    dname, byid[iid]['name']
+                )
+            })
+            volumes[dname] = dev['Ebs']['VolumeId']
+            count += 1
+        persist(byid[iid], {'awsvolumes': volumes})
+
+    batch.flush()
+    print("tagged {0} volume(s) of {1} instance(s)".format(
+        count, len(devices)
+    ))
+
+    missing = [byid[iid]['name'] for iid in ids if not iid in devices]
+    if missing:
+        raise WaiterTimeout('no block device showed up for {0}'.format(
+            ', '.join(missing)
+        ))
+
 def create():
     '''Create instance(s) described in the ``yaml`` file passed in parameter
+
+    Every step is scheduled in a dependency graph: subnets are checked before
+    the instances using them, subnets sharing a route table one after the
+    other, ELB registration waits for its instance and the subnets of its
+    network, and regions never wait for each other. Independent steps run in
+    parallel on ``EC2JOBS`` workers (defaults to 4), and a failure only skips
+    the steps depending on it. Once every instance is launched, volumes are
+    tagged region by region in bulk.
+
+    Created resources are recorded in a journal next to the ``yaml`` file,
+    which is compacted back into the latter from time to time and at exit.
     '''
     yf = sys.argv[2]
     y = getyaml(create.__name__, yf)
+    journal = Journal(yf, y)
+
+    sched = Scheduler(int(os.environ.get('EC2JOBS', 4)))
+    lock = threading.Lock()
+    launched = []
+    withdata = {}
+
+    def persist(instance, state):
+        if 'awsid' in state:
+            with lock:
+                launched.append(instance)
+        journal.record(instance, state)
 
     for reg in y: # loop through profiles
-        ec2 = Aws(reg, 'ec2')
-        ec2r = ec2.resource
+        rctx = Context(reg)
+        ec2 = rctx.ec2
+        # build the client once, before workers share it
+        ec2.client
+
+        # subnet jobs sharing a route table are chained, as the first one
+        # creates it; last job of every chain by route table name
+        rtdeps = {}
+        launches = []
+        natnames = set()
         for azlst in y[reg]: # loop through AZ list
             if 'vpc' in azlst:
-                vpc = ec2.get_obj_from_nametag('vpcs', azlst['vpc'])
-                print('> selected {0}'.format(vpc.id))
+                rctx.vpc = ec2.get_obj_from_nametag('vpcs', azlst['vpc'])
+                print('> selected {0}'.format(rctx.vpc.id))
                 continue
             for az in azlst: # loop through AZ
                 for instance in azlst[az]:
@@ -478,147 +836,91 @@ def create():
                             continue
 
                     # check for RDS instance
+                    rtname = _rtname(instance)
                     if instance['type'].startswith('db.'):
-                        create_rds(ec2, az, instance)
+                        key = '{0}/rds/{1}'.format(reg, instance['name'])
+                        sched.add(
+                            key, create_rds, (rctx, az, instance),
+                            rtdeps.get(rtname, [])
+                        )
+                        rtdeps[rtname] = [key]
+                        natnames.add(_natname(instance))
                         continue
 
                     # check AZ / subnet existence, create it if absent
-                    subnet_check(ec2, az, instance)
-
-                    if 'debian' in instance['image']:
-                        image = ec2.get_debian_ami(instance['image'])
-                    else:
-                        image = ec2.getami(instance['image'])
-                    sg = []
-                    for sglist in instance['sg']:
-                        sg.append(ec2.get_id_from_nametag(
-                            'security_groups', sglist
-                        ))
-                    subnet = ec2.get_id_from_nametag('subnets', az)
-
-                    if 'data' in instance:
-                        blockdevmap = [
-                            {
-                                'DeviceName': '/dev/xvdb',
-                                'Ebs': {
-                                    'VolumeSize': instance['data'],
-                                    'DeleteOnTermination': True,
-                                }
-                            }
-                        ]
-                    else:
-                        blockdevmap = []
-
-                    netint = []
-                    if 'pubip' in instance and instance['pubip'] is True:
-                        pubip = True
-                    else:
-                        pubip = False
-
-                    # Here, 'name' is the tag Name
-
-                    # netblock for a NAT-type instance
-                    netblock = '{0}.0.0/16'.format(
-                        '.'.join(instance['ipaddr'].split('.')[:2])
-                    )
-                    print("creating instance {0}".format(instance['name']))
-                    rc = ec2r.create_instances(
-                        ImageId = image,
-                        MinCount = 1,
-                        MaxCount = 1,
-                        KeyName = instance['key'],
-                        InstanceType = instance['type'],
-                        BlockDeviceMappings = blockdevmap,
-                        NetworkInterfaces = [{
-                            'DeviceIndex': 0,
-                            'Groups': sg,
-                            'SubnetId': subnet,
-                            'PrivateIpAddress': instance['ipaddr'],
-                            'DeleteOnTermination': True,
-                            'AssociatePublicIpAddress': pubip
-                        }],
-                        UserData = ec2.mkuserdata(
-                            b64 = False,
-                            userdata = instance['userdata'],
-                            name = instance['name'],
-                            netblock = netblock
-                        )
-                    )
-
-                    iid = rc[0].id
-
-                    instance['awsid'] = iid
-                    tags = ['name', 'customer']
-                    # add custom fields
-                    if ext_available is True:
-                        newtags = ext.addfields(reg, instance)
-                        if newtags:
-                            tags.extend(newtags)
-                    # give the instance a tag name
-                    # we are supposed to be able to pass many tags to
-                    # create_tags but a traceback occurs as of boto3 0.0.21
-                    for tag in tags:
-                        print(
-                            "tagging instance id {0} {1} to {2}".format(
-                                iid, tag, instance[tag]
-                            )
+                    key = '{0}/subnet/{1}'.format(reg, az)
+                    if not key in sched:
+                        sched.add(
+                            key, subnet_check, (rctx, az, instance),
+                            rtdeps.get(rtname, [])
                         )
-                        wait4tag(ec2r.Instance(iid), tag, instance[tag])
-
-                    with open(sys.argv[2], 'w') as f:
-                        yaml.dump(y, f, default_flow_style=False)
+                        rtdeps[rtname] = [key]
+                    natnames.add(_natname(instance))
 
-                    # Mostly for NAT instances
-                    if 'srcdstchk' in instance:
-                        r = ec2r.Instance(iid).modify_attribute(
-                            SourceDestCheck  = {
-                                'Value': instance['srcdstchk']
-                            }
-                        )
+                    launches.append((az, instance, key))
 
-                    # optionally do something with instance informations
-                    # like inserting it to your own information system
-                    if ext_available is True:
-                        ext.instance_actions(ec2, reg, az, instance)
+        # every NAT instance the network jobs may need, in one call
+        if natnames:
+            rctx.topology.load_nats(natnames)
 
-                    # create ELB if needed
-                    if 'elb' in instance:
-                        elb_register(ec2, y[reg], az, instance)
+        lbdeps = {}
+        for az, instance, subkey in launches:
+            key = '{0}/instance/{1}'.format(reg, instance['name'])
+            sched.add(
+                key, _launch, (rctx, reg, az, instance, persist), [subkey]
+            )
 
-                    # create additionnal block devices if needed
-                    if not blockdevmap:
-                        continue
+            # create ELB if needed, one registration at a time per ELB
+            if 'elb' in instance:
+                lbname = 'elb-{0}'.format(instance['name'][:-2])
+                elbkey = '{0}/elb/{1}'.format(reg, instance['name'])
+                # the ELB spans every AZ of the instance network
+                curnet = az[:-4]
+                netkeys = [
+                    '{0}/subnet/{1}'.format(reg, yaz)
+                    for azlst in y[reg] for yaz in azlst
+                    if yaz != 'vpc' and curnet in yaz
+                ]
+                sched.add(
+                    elbkey, elb_register,
+                    (rctx, y[reg], az, instance, persist),
+                    [key] + [k for k in netkeys if k in sched] +
+                    rtdeps.get(_rtname(instance), []) +
+                    lbdeps.get(lbname, [])
+                )
+                lbdeps[lbname] = [elbkey]
+
+            # additionnal block devices are tagged once launched
+            if 'data' in instance:
+                withdata.setdefault(reg, (rctx, []))[1].append(instance)
+
+    failed = sched.run()
+
+    # second phase, tag additionnal block devices
+    sched = Scheduler(int(os.environ.get('EC2JOBS', 4)))
+    done = set(id(i) for i in launched)
+    for reg in sorted(withdata):
+        rctx, instances = withdata[reg]
+        instances = [i for i in instances if id(i) in done]
+        if instances:
+            sched.add(
+                '{0}/volumes'.format(reg), _tag_volumes,
+                (rctx, instances, persist)
+            )
+    failed.update(sched.run())
 
-                    devlst = []
-                    print("waiting for block devices to rise")
-                    while not devlst:
-                        devlst = ec2r.Instance(iid).block_device_mappings
-                        time.sleep(1)
-
-                    for dev in devlst:
-                        dname = dev['DeviceName'][5:]
-                        print(
-                            "tagging volume {0} to {1}_{2}".format(
-                                dev['Ebs']['VolumeId'],
-                                dname,
-                                instance['name']
-                            )
-                        )
-                        tags = {
-                            'Name': '{0}_{1}'.format(
-                                dname, instance['name']
-                            ),
-                            'Customer': instance['customer']
-                        }
-                        ec2.client.create_tags(
-                            Resources = [dev['Ebs']['VolumeId']],
-                            Tags = ec2.mktags(tags)
-                        )
+    journal.close()
 
     # final actions if needed
     if ext_available is True:
         ext.final_actions()
 
+    if failed:
+        print('{0} failed job(s): {1}'.format(
+            len(failed), ', '.join(sorted(failed))
+        ))
+        sys.exit(1)
+
 def rm():
     '''Destroys an AWS instance
     '''
@@ -636,7 +938,7 @@ def rm():
     # RDS instance
     if not sys.argv[2].startswith('i-'):
         dbid = sys.argv[2]
-        rds = Aws(ec2.profile, 'rds')
+        rds = ctx.service('rds')
         try:
             rds.client.delete_db_instance(
                 DBInstanceIdentifier = dbid, SkipFinalSnapshot = True
@@ -650,74 +952,50 @@ def rm():
 
     # pre-delete external actions
     if ext_available is True:
-        ext.rm_actions(ec2, sys.argv[2:])
+        ext.rm_actions(ctx.ec2, sys.argv[2:])
 
     try:
-        ec2.resource.instances.filter(InstanceIds=sys.argv[2:]).terminate()
+        ctx.ec2.resource.instances.filter(InstanceIds=sys.argv[2:]).terminate()
     except:
         print('error while terminating {0}'.format(sys.argv[2:]))
         sys.exit(1)
 
-def _update_price(total, price):
-    return {
-        'ondemand': round(total['ondemand'] + float(price['ondemand']), 5),
-        'noup': round(total['noup'] + float(price['yrTerm1']['noup']), 5),
-        '1yearpartup': round(total['1yearpartup'] + \
-            float(price['yrTerm1']['partial']), 5),
-        '1yearfullup': round(total['1yearfullup'] + \
-            float(price['yrTerm1']['full']), 5),
-        '3yearpartup': round(total['3yearpartup'] + \
-            float(price['yrTerm3']['partial']), 5),
-        '3yearfullup': round(total['3yearfullup'] + \
-            float(price['yrTerm3']['full']), 5)
-    }
-
-def _print_total_price(price):
-    titles = [
-        {'ondemand': 'on demand'},
-        {'noup': '1 y no up'},
-        {'1yearpartup': '1 y part up'},
-        {'1yearfullup': '1 y full up'},
-        {'3yearpartup': '3 y part up'},
-        {'3yearfullup': '3 y full up'}
-    ]
-    duration = {'hrly': 1, 'mthly': 24 * 30.5, 'yrly': 24 * 30.5 * 12}
-
-
-    prices = []
-    for t in titles:
-        prices.append(float(price[t.keys()[0]]))
+def _print_total_price(fleet):
+    '''Renders a ``cost.fleet_cost`` result, also written to ``prices.csv``
 
+    :param dict fleet: Fleet cost
+    '''
     with open('prices.csv', 'w') as f:
         f.write('durat,{0}\n'.format(
-            ','.join([x.values()[0] for x in titles]))
+            ','.join([o[1] for o in cost.options]))
         )
-        for d in sorted(duration, key=duration.get):
-            f.write('{0},{1}\n'.format(
-                d, ','.join([str(p * duration[d]) for p in prices])
-            ))
+        for d in cost.durations:
+            f.write('{0},{1}\n'.format(d[0], ','.join([
+                str(fleet['totals'][d[0]][o[0]]) for o in cost.options
+            ])))
 
     with open('prices.csv', 'r') as f:
         print(from_csv(f))
 
+    if fleet['missing']:
+        print('/!\\ no price for {0}'.format(', '.join(fleet['missing'])))
 
-zero_price = {
-    'ondemand': 0.0,
-    'noup': 0.0,
-    '1yearpartup': 0.0,
-    '1yearfullup': 0.0,
-    '3yearpartup' : 0.0,
-    '3yearfullup': 0.0
-}
+def _count(t, counts, az, itype):
+    '''Counts an instance type per AZ and in total
+    '''
+    saz = az.split('-')[-1]
+    t.setdefault(saz, {})
+    t[saz][itype] = t[saz].get(itype, 0) + 1
+    counts[itype] = counts.get(itype, 0) + 1
 
 def lsyaml():
     '''Lists instances types used in the descriptive ``yaml`` file
     '''
     t = {}
-    fulllist = ap.get_all_instances(
-        ec2.region, 'ec2', 'ri-v2/linux-unix-shared'
-    )
-    total_price = zero_price
+    counts = {}
+    fulllist = ap.PriceIndex(ap.get_all_instances(
+        ctx.ec2.region, 'ec2', 'ri-v2/linux-unix-shared'
+    ))
     for f in sys.argv[2:]:
         y = getyaml(lsyaml.__name__, f)
 
@@ -725,56 +1003,139 @@ def lsyaml():
             for azlst in y[reg]: # loop through AZ list
                 for az in azlst: # loop through AZ
                     for instance in azlst[az]:
-                        saz = az.split('-')[-1]
-                        if not saz in t:
-                            t[saz] = {instance['type']:  0}
-    
-                        if instance['type'] in t[saz]:
-                            t[saz][instance['type']] += 1
-                        else:
-                            t[saz][instance['type']] = 1
-
-                        prices = ap.instance_price(fulllist, instance['type'])
-                        total_price = _update_price(total_price, prices)
+                        _count(t, counts, az, instance['type'])
 
     print(yaml.dump(t, default_flow_style=False))
 
-    _print_total_price(total_price)
+    _print_total_price(cost.fleet_cost(counts, fulllist))
+
+def _lsec2_instances(ec2, namefilter):
+    '''Counts instances matching a Name filter per AZ and per type
+    '''
+    t = {}
+    counts = {}
+    for i in ec2.iterinstances(
+        [{'Name': 'tag:Name', 'Values': [namefilter]}]
+    ):
+        _count(t, counts, i['az'], i['type'])
+    return t, counts
+
+def _lsec2_account(ec2):
+    '''Returns the account id a profile works on
+    '''
+    sts = Aws(ec2.profile, 'sts')
+    return sts.client.get_caller_identity()['Account']
+
+def _sum_costs(costs):
+    '''Sums ``cost.fleet_cost`` results
+    '''
+    total = {
+        'hourly': dict((o[0], 0.0) for o in cost.options),
+        'totals': dict(
+            (d[0], dict((o[0], 0.0) for o in cost.options))
+            for d in cost.durations
+        ),
+        'missing': [],
+    }
+    for c in costs:
+        for o in cost.options:
+            total['hourly'][o[0]] += c['hourly'][o[0]]
+            for d in cost.durations:
+                total['totals'][d[0]][o[0]] += c['totals'][d[0]][o[0]]
+        total['missing'].extend(
+            [m for m in c['missing'] if not m in total['missing']]
+        )
+    return total
 
 def lsec2():
     '''List instances types used in EC2
+
+    Profiles to report on can follow the name filter, ``all`` meaning every
+    configured profile; instances of all profiles are then fetched
+    concurrently on ``EC2JOBS`` workers (defaults to 4) and merged per region
+    and globally. Profiles working on the same account and region, like
+    ``default`` and a named one, are only counted once, and profiles without
+    a region are skipped::
+
+        ec2.py lsec2 'foo-*' frankfurt ireland
+        ec2.py lsec2 'foo-*' all
     '''
     if len(sys.argv) < 3:
         print(
-            'usage: {0} {1} \'name filter\''.format(
+            'usage: {0} {1} \'name filter\' [profile ...|all]'.format(
                 sys.argv[0], lsec2.__name__
             )
         )
         sys.exit(1)
 
-    t = {}
-    total_price = zero_price
-    fulllist = ap.get_all_instances(
-        ec2.region, 'ec2', 'ri-v2/linux-unix-shared'
-    )
-    for i in ec2.resource.instances.filter(
-        Filters=[{'Name': 'tag:Name', 'Values': [sys.argv[2]]}]
-    ):
-        az = i.placement['AvailabilityZone'].split('-')[-1]
-        if not az in t:
-            t[az] = {i.instance_type: 0}
-
-        if i.instance_type in t[az]:
-            t[az][i.instance_type] += 1
-        else:
-            t[az][i.instance_type] = 1
-
-        prices = ap.instance_price(fulllist, i.instance_type)
-        total_price = _update_price(total_price, prices)
-
-    print(yaml.dump(t, default_flow_style=False))
+    namefilter = sys.argv[2]
+    plist = sys.argv[3:] or [ctx.profile]
+    if plist == ['all']:
+        plist = profiles()
+
+    accounts = []
+    # named profiles first, so they are kept over an identical default
+    for p in sorted(set(plist), key = lambda p: (p == 'default', p)):
+        a = Aws(p, 'ec2')
+        if a.region is None:
+            print('skipping profile {0}: no region configured'.format(p))
+            continue
+        accounts.append(a)
+    if not accounts:
+        sys.exit(1)
 
-    _print_total_price(total_price)
+    pool = ThreadPool(max(1, min(
+        int(os.environ.get('EC2JOBS', 4)), len(accounts)
+    )))
+    try:
+        if len(accounts) > 1:
+            ids = pool.map(_lsec2_account, accounts)
+            seen = {}
+            for a, aid in zip(accounts, ids):
+                seen.setdefault((aid, a.region), a)
+            accounts = [a for a in accounts if a in seen.values()]
+
+        regions = sorted(set(a.region for a in accounts))
+        listed = [
+            pool.apply_async(_lsec2_instances, (a, namefilter))
+            for a in accounts
+        ]
+
+        # one price model download and parse for every region
+        fulllists = ap.get_regions_instances(
+            regions, 'ec2', 'ri-v2/linux-unix-shared'
+        )
+        priced = dict(
+            (r, ap.PriceIndex(fulllists.get(r) or {'instanceTypes': []}))
+            for r in regions
+        )
+        listed = [l.get() for l in listed]
+    finally:
+        pool.close()
+        pool.join()
+
+    byregion = {}
+    for a, (t, counts) in zip(accounts, listed):
+        rt, rcounts = byregion.setdefault(a.region, ({}, {}))
+        for az in t:
+            for itype in t[az]:
+                rt.setdefault(az, {})
+                rt[az][itype] = rt[az].get(itype, 0) + t[az][itype]
+        for itype in counts:
+            rcounts[itype] = rcounts.get(itype, 0) + counts[itype]
+
+    costs = []
+    for r in regions:
+        t, counts = byregion[r]
+        if len(regions) > 1:
+            print('> {0}'.format(r))
+        print(yaml.dump(t, default_flow_style=False))
+        costs.append(cost.fleet_cost(counts, priced[r]))
+        _print_total_price(costs[-1])
+
+    if len(regions) > 1:
+        print('> all regions')
+        _print_total_price(_sum_costs(costs))
 
 
 if __name__ == '__main__':
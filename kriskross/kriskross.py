@@ -5,20 +5,28 @@ Starts an AWS console from the shell based on cross account roles.
 See `README.md` for more details.
 
 Usage:
-  kriskross.py <target> [--awsaccounts=<file> --mfa=<token>]
+  kriskross.py <target> [--awsaccounts=<file> --mfa=<token> --cache]
+
+Options:
+  --cache  Keep assumed role credentials in ~/.kriskross.cache until they
+           expire, so later launches skip STS and MFA.
 
 """
 
 import os
 import sys
 import json
+import time
 import uuid
 import boto3
+import calendar
+import threading
 import requests
 import webbrowser
 from docopt import docopt
+from multiprocessing.pool import ThreadPool
 from distutils.spawn import find_executable
-from flask import Flask, request, render_template, url_for
+from flask import Flask, request, render_template, url_for, jsonify
 
 app = Flask(__name__)
 
@@ -28,26 +36,102 @@ browser_private_flag = {
     'firefox': '--private-window'
 }
 
-def loadprefs():
-    """load preferences file
+# assumed role credentials by target, renewed this many seconds before expiry
+creds_cache = {}
+creds_lock = threading.Lock()
+creds_margin = 300
+creds_file = '{0}/.kriskross.cache'.format(os.path.expanduser('~'))
+
+# parsed preferences, reloaded when the file changes
+prefs_cache = {}
+prefs_lock = threading.Lock()
+
+# pooled connections to the federation endpoint
+http = requests.Session()
+http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize = 8))
+
+# web service authentications, run in the background and polled by the page
+auth_pool = None
+auth_jobs = {}
+auth_lock = threading.Lock()
+auth_workers = 4
+auth_keep = 600
+
+def loadprefs(awsaccounts = None):
+    """load preferences file, unless unchanged since last load
     """
-    if 'awsaccounts' not in locals() or awsaccounts == None:
+    if awsaccounts == None:
         awsaccounts = '{0}/.awsaccounts'.format(os.path.expanduser('~'))
 
-    return json.load(open(awsaccounts))
+    mtime = os.stat(awsaccounts).st_mtime
+    with prefs_lock:
+        if prefs_cache.get('path') != awsaccounts or \
+            prefs_cache.get('mtime') != mtime:
+            with open(awsaccounts) as f:
+                prefs_cache['prefs'] = json.load(f)
+            prefs_cache['path'] = awsaccounts
+            prefs_cache['mtime'] = mtime
 
+        return prefs_cache['prefs']
 
-def do_auth(prefs, target, mfatoken):
-    """Assume role, retrieve temporary token, authenticate and launch browser
+
+def load_creds(cachefile):
+    """load credentials cache file
     """
-    signin_url = 'https://signin.aws.amazon.com/federation'
-    console_url = 'https://console.aws.amazon.com/'
+    try:
+        with open(cachefile) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
 
-    # prepare assume role parameters
-    params = {}
-    params['RoleArn'] = 'arn:aws:iam::{0}:role/{1}'.format(
+
+def save_creds(cachefile, creds):
+    """save credentials cache file, only readable by ourselves
+    """
+    fd = os.open(cachefile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(creds, f)
+
+
+def get_creds(prefs, target, mfatoken, cachefile = None):
+    """Return assumed role credentials, from cache while they are valid
+    """
+    arn = 'arn:aws:iam::{0}:role/{1}'.format(
         prefs[target]['account'], prefs[target]['role']
     )
+
+    def valid(c):
+        return c is not None and c['arn'] == arn and \
+            c['expiration'] - creds_margin > time.time()
+
+    with creds_lock:
+        if valid(creds_cache.get(target)):
+            return creds_cache[target]
+        if cachefile is not None:
+            cached = load_creds(cachefile)
+            if valid(cached.get(target)):
+                creds_cache[target] = cached[target]
+                return cached[target]
+
+    creds = assume_role(prefs, target, arn, mfatoken)
+
+    with creds_lock:
+        creds_cache[target] = creds
+        if cachefile is not None:
+            cached = load_creds(cachefile)
+            cached[target] = creds
+            save_creds(cachefile, cached)
+
+    return creds
+
+
+def assume_role(prefs, target, arn, mfatoken):
+    """Assume role and return temporary credentials
+    """
+    # prepare assume role parameters
+    params = {}
+    params['RoleArn'] = arn
     # random hexadecimal
     params['RoleSessionName'] = uuid.uuid4().hex
     # ExternalId for 3rd party accounts
@@ -69,20 +153,38 @@ def do_auth(prefs, target, mfatoken):
     s = boto3.Session(**p)
     sts = s.client('sts')
 
-    creds = sts.assume_role(**params)
+    creds = sts.assume_role(**params)['Credentials']
+
+    return {
+        'arn': arn,
+        'sessionId': creds['AccessKeyId'],
+        'sessionKey': creds['SecretAccessKey'],
+        'sessionToken': creds['SessionToken'],
+        'expiration': calendar.timegm(creds['Expiration'].utctimetuple())
+    }
+
+
+def do_auth(prefs, target, mfatoken, cachefile = None):
+    """Assume role, retrieve temporary token, authenticate and launch browser
+    """
+    signin_url = 'https://signin.aws.amazon.com/federation'
+    console_url = 'https://console.aws.amazon.com/'
+
+    creds = get_creds(prefs, target, mfatoken, cachefile)
 
     json_creds = json.dumps(
         {
-            'sessionId': creds['Credentials']['AccessKeyId'],
-            'sessionKey': creds['Credentials']['SecretAccessKey'],
-            'sessionToken': creds['Credentials']['SessionToken']
+            'sessionId': creds['sessionId'],
+            'sessionKey': creds['sessionKey'],
+            'sessionToken': creds['sessionToken']
         }
     )
 
     params = {'Action': 'getSigninToken', 'Session': json_creds}
 
 
-    r = requests.get(signin_url, params = params)
+    r = http.get(signin_url, params = params)
+    r.raise_for_status()
 
     params = {
         'Action': 'login',
@@ -114,6 +216,45 @@ def do_auth(prefs, target, mfatoken):
     webbrowser.open(uri)
 
 
+def auth_job(jobid, prefs, target, mfatoken):
+    """Background authentication, result is kept for the status endpoint
+    """
+    try:
+        do_auth(prefs, target, mfatoken)
+        state = {'msg': 'success', 'err': None}
+    except Exception, e:
+        state = {'msg': 'danger', 'err': str(e)}
+
+    with auth_lock:
+        auth_jobs[jobid].update(state)
+
+
+def submit_auth(prefs, target, mfatoken):
+    """Queue an authentication and return its job id
+    """
+    global auth_pool
+
+    if target not in prefs:
+        raise KeyError('unknown target {0}'.format(target))
+
+    jobid = uuid.uuid4().hex
+    now = time.time()
+    with auth_lock:
+        if auth_pool is None:
+            auth_pool = ThreadPool(auth_workers)
+        # forget old results nobody polled
+        for k in [k for k in auth_jobs if auth_jobs[k]['time'] + auth_keep < now]:
+            del auth_jobs[k]
+        auth_jobs[jobid] = {
+            'id': jobid, 'target': target, 'msg': 'pending', 'err': None,
+            'time': now
+        }
+
+    auth_pool.apply_async(auth_job, (jobid, prefs, target, mfatoken))
+
+    return jobid
+
+
 @app.route('/', methods=['GET', 'POST'])
 def web_service():
     """Minimal web service to receive MFA
@@ -125,23 +266,39 @@ def web_service():
     if request.method == 'POST':
         try:
             target = request.form['target']
-            do_auth(prefs, target, request.form['mfa'])
-            msg = 'success'
+            submit_auth(prefs, target, request.form.get('mfa') or None)
         except Exception, e:
             msg = 'danger'
             err = str(e)
 
+    with auth_lock:
+        jobs = sorted(
+            [dict(j) for j in auth_jobs.values()], key = lambda j: j['time']
+        )
+
     return render_template(
-        'targets.html', prefs = prefs, msg = msg, err = err, target = target
+        'targets.html', prefs = prefs, msg = msg, err = err, target = target,
+        jobs = jobs
     )
 
 
+@app.route('/status/<jobid>')
+def auth_status(jobid):
+    """Status of a background authentication, polled by the page
+    """
+    with auth_lock:
+        if jobid not in auth_jobs:
+            return jsonify({'id': jobid, 'msg': 'danger', 'err': 'unknown job'}), 404
+        return jsonify(auth_jobs[jobid])
+
+
 if __name__ == "__main__":
     args = docopt(__doc__, version = 'kriskross 0.3')
 
     target = args.get('<target>')
     awsaccounts = args.get('--awsaccounts')
     mfatoken = args.get('--mfa')
+    cachefile = creds_file if args.get('--cache') else None
 
-    do_auth(loadprefs(), target, mfatoken)
+    do_auth(loadprefs(awsaccounts), target, mfatoken, cachefile)
 
@@ -30,13 +30,98 @@ Typical usage:
       )
       ap.instance_price(fulllist, 'm3.xlarge')
 
+Price lists are kept in a local catalog, see ``get_all_instances``. Every
+download goes through a shared keep-alive ``requests`` session and is made
+conditional on the copy downloaded last time. ``prefetch_all`` warms the
+catalog for every resource type of a resource at once.
+
 '''
 
 import requests
 import re
 import sys
 import json
+import threading
 from bs4 import BeautifulSoup
+from multiprocessing.pool import ThreadPool
+
+try:
+    from mods.cache import DiskCache
+except ImportError:  # running as a script from mods/
+    from cache import DiskCache
+
+# local price catalog, prices do not change often; one file per resource,
+# resource type and region, so a lookup only reads the region it needs
+catalog = DiskCache('prices', ttl = 7 * 86400, sharded = True)
+# last downloaded pages, along with their ETag and Last-Modified headers,
+# one file per page
+pages = DiskCache('pricepages', sharded = True)
+
+# parallel downloads
+maxfetch = 8
+
+_http = None
+_http_lock = threading.Lock()
+_models = {}
+
+def http():
+    '''Returns the shared ``requests`` session, keeping connections alive
+
+    :rtype: requests.Session
+    '''
+    global _http
+    with _http_lock:
+        if _http is None:
+            _http = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize = maxfetch)
+            _http.mount('http://', adapter)
+            _http.mount('https://', adapter)
+        return _http
+
+def fetch(url):
+    '''Downloads a page, unless it did not change since last download
+
+    :param str url: URL to download
+
+    :return: Page content
+    :rtype: str
+    '''
+    last = pages.entry(url)
+    headers = {}
+    if last is not None:
+        if last.get('etag'):
+            headers['If-None-Match'] = last['etag']
+        if last.get('modified'):
+            headers['If-Modified-Since'] = last['modified']
+
+    r = http().get(url, headers = headers)
+    if r.status_code == 304 and last is not None:
+        return last['value']
+    r.raise_for_status()
+
+    pages.set(
+        url, r.text,
+        etag = r.headers.get('ETag'), modified = r.headers.get('Last-Modified')
+    )
+    return r.text
+
+def fetch_all(urls):
+    '''Downloads many pages in parallel
+
+    :param list urls: URLs to download
+
+    :return: Pages content, in ``urls`` order
+    :rtype: list
+    '''
+    if len(urls) < 2:
+        return [fetch(u) for u in urls]
+
+    pool = ThreadPool(min(maxfetch, len(urls)))
+    try:
+        return pool.map(fetch, urls)
+    finally:
+        pool.close()
+        pool.join()
 
 def get_awshtml(resource):
     '''Retrieve JS from AWS website for a given resource (``ec2`` or ``rds``)
@@ -46,18 +131,20 @@ def get_awshtml(resource):
     :return text:
     :rtype: str
     '''
-    return BeautifulSoup(requests.get(
+    return BeautifulSoup(fetch(
         'http://aws.amazon.com/{0}/pricing/'.format(resource)
-    ).text)
+    ))
 
 def get_models(resource):
-    '''Retrieve available models
+    '''Retrieve available models, the pricing page is only parsed once
 
     :param str resource: Resource to query, ``ec2`` or ``rds``
 
     :return urllist: List of available models urls
     :rtype: list
     '''
+    if resource in _models:
+        return _models[resource]
 
     s = get_awshtml(resource)
     urllist = []
@@ -66,8 +153,264 @@ def get_models(resource):
         if r and r.group(1):
             urllist.append('http:{0}'.format(r.group(1)))
 
+    _models[resource] = urllist
     return urllist
 
+# JS object literal tokens: punctuation, quoted strings or bare words
+_jstoken = re.compile(
+    r'\s*(?:([{}\[\]:=,])|"((?:[^"\\]|\\.)*)"|\'((?:[^\'\\]|\\.)*)\'|'
+    r'([\w$.+-]+))'
+)
+# brackets and string delimiters, to find where a value ends
+_jsbound = re.compile(r'[{}\[\]"\']')
+_jsstring = {
+    '"': re.compile(r'"(?:[^"\\]|\\.)*"'),
+    "'": re.compile(r"'(?:[^'\\]|\\.)*'"),
+}
+# unquoted keys, only right after an opening brace or a comma
+_jskey = re.compile(r'([{,]\s*)([A-Za-z0-9_$-]+)\s*:')
+
+class _JSParser(object):
+    '''Incremental parser for JavaScript object literals, like the ones found
+    in AWS price models (unquoted keys, ``JSON`` like values)
+
+    The text is never copied, tokens are matched in place.
+
+    :param str text: Text to parse
+    :param int pos: Where to start parsing
+    '''
+    def __init__(self, text, pos = 0):
+        self.text = text
+        self.pos = pos
+
+    def peek(self):
+        m = _jstoken.match(self.text, self.pos)
+        if m is None:
+            raise ValueError('unexpected data at {0}'.format(self.pos))
+        return m
+
+    def next(self):
+        m = self.peek()
+        self.pos = m.end()
+        if m.group(1) is not None:
+            return ('punct', m.group(1))
+        if m.group(2) is not None:
+            return ('str', json.loads('"{0}"'.format(m.group(2))))
+        if m.group(3) is not None:
+            return ('str', m.group(3).replace("\\'", "'"))
+        word = m.group(4)
+        if word in ('true', 'false', 'null'):
+            return ('const', {'true': True, 'false': False, 'null': None}[word])
+        try:
+            return ('num', int(word))
+        except ValueError:
+            pass
+        try:
+            return ('num', float(word))
+        except ValueError:
+            return ('str', word)
+
+    def expect(self, punct):
+        tok = self.next()
+        if tok != ('punct', punct):
+            raise ValueError(
+                'expected {0} at {1}, got {2}'.format(punct, self.pos, tok[1])
+            )
+
+    def keys(self):
+        '''Yields keys of the object being parsed, the caller must consume
+        each value before asking for the next key
+        '''
+        while True:
+            tok = self.next()
+            if tok == ('punct', '}'):
+                return
+            if tok == ('punct', ','):
+                continue
+            if tok[0] == 'punct':
+                raise ValueError('unexpected {0} at {1}'.format(tok[1], self.pos))
+            if self.next()[1] not in (':', '='):
+                raise ValueError('expected : at {0}'.format(self.pos))
+            yield tok[1]
+
+    def items(self):
+        '''Yields once per item of the array being parsed, the caller must
+        consume each item
+        '''
+        while True:
+            m = self.peek()
+            if m.group(1) == ']':
+                self.pos = m.end()
+                return
+            if m.group(1) == ',':
+                self.pos = m.end()
+                continue
+            yield
+
+    def span(self):
+        '''Returns where the next object or array ends, without parsing it
+
+        :rtype: int
+        '''
+        m = self.peek()
+        if m.group(1) not in ('{', '['):
+            return m.end()
+        depth = 0
+        pos = m.start(1)
+        while True:
+            b = _jsbound.search(self.text, pos)
+            if b is None:
+                raise ValueError('unterminated value at {0}'.format(self.pos))
+            c = b.group(0)
+            if c in _jsstring:
+                pos = _jsstring[c].match(self.text, b.start()).end()
+                continue
+            depth += 1 if c in '{[' else -1
+            pos = b.end()
+            if depth == 0:
+                return pos
+
+    def fastvalue(self):
+        '''Parses the next value by handing it over to the ``json`` module,
+        which is much faster than ``value`` on big objects
+
+        Only the value text is copied and rewritten, falls back to ``value``
+        if the result is not valid ``JSON``.
+        '''
+        start = self.peek().start(1)
+        end = self.span()
+        try:
+            v = json.loads(_jskey.sub(r'\1"\2":', self.text[start:end]))
+        except (ValueError, TypeError):
+            return self.value()
+        self.pos = end
+        return v
+
+    def value(self):
+        '''Parses and returns the next value
+        '''
+        tok = self.next()
+        if tok == ('punct', '{'):
+            obj = {}
+            for k in self.keys():
+                obj[k] = self.value()
+            return obj
+        if tok == ('punct', '['):
+            arr = []
+            for _ in self.items():
+                arr.append(self.value())
+            return arr
+        if tok[0] == 'punct':
+            raise ValueError('unexpected {0} at {1}'.format(tok[1], self.pos))
+        return tok[1]
+
+def iter_regions(text):
+    '''Yields regions of a price model payload one at a time
+
+    Regions are parsed on demand, so a caller looking for a single region
+    stops parsing as soon as it is found.
+
+    :param str text: Model payload, like ``callback({config:{...}})``
+
+    :return: Price list of each region
+    :rtype: generator
+    '''
+    # as of 31/05/2015, format is
+    # od: callback({vers=0.01,config{:{...}});
+    # reserved: callback({config{:{...}},vers:0.01});
+    start = text.find('(')
+    if start < 0:
+        return
+    p = _JSParser(text, start + 1)
+    p.expect('{')
+    for key in p.keys():
+        if key != 'config':
+            p.value()
+            continue
+        p.expect('{')
+        for ckey in p.keys():
+            if ckey != 'regions':
+                p.value()
+                continue
+            p.expect('[')
+            for _ in p.items():
+                yield p.fastvalue()
+        return
+
+def model_version(text):
+    '''Returns a price model payload version
+
+    :param str text: Model payload
+
+    :rtype: str
+    '''
+    vers = re.search('vers[:=]([0-9.]+)', text)
+    return vers.group(1) if vers else None
+
+def get_model(resource, restype):
+    '''Downloads a price model payload
+
+    :param str resource: Resource to query, ``ec2`` or ``rds``
+    :param str restype: Resource type (``linux-od``, ``rhel-od`` ...)
+
+    :return: Model payload or ``None``
+    :rtype: str
+    '''
+    for url in get_models(resource):
+        if restype in url:
+            return fetch(url)
+
+    return None
+
+def get_catalog(resource, restype):
+    '''Returns attributes or price list by regions along with its version
+
+    :param str resource: Resource to query, ``ec2`` or ``rds``
+    :param str restype: Resource type (``linux-od``, ``rhel-od`` ...)
+
+    :return: Price list by regions and model version
+    :rtype: tuple
+    '''
+    text = get_model(resource, restype)
+    if text is None:
+        return ([], None)
+
+    return (list(iter_regions(text)), model_version(text))
+
+def _catalog_key(resource, restype, region):
+    return '{0}|{1}|{2}'.format(resource, restype, region)
+
+def _store_catalog(resource, restype, text):
+    pricelist = list(iter_regions(text))
+    catalog.setmany(
+        dict((_catalog_key(resource, restype, r['region']), r)
+            for r in pricelist),
+        version = model_version(text)
+    )
+    return pricelist
+
+def prefetch_all(resource):
+    '''Downloads every price model of a resource in parallel and stores them
+    in the local catalog
+
+    :param str resource: Resource to query, ``ec2`` or ``rds``
+
+    :return: Stored resource types
+    :rtype: list
+    '''
+    restypes = []
+    urls = []
+    for url in get_models(resource):
+        restype = re.search('.*/{0}/(.+)\.min\.js'.format(resource), url)
+        if restype and restype.group(1):
+            restypes.append(restype.group(1))
+            urls.append(url)
+
+    for restype, text in zip(restypes, fetch_all(urls)):
+        _store_catalog(resource, restype, text)
+
+    return restypes
+
 def get_regions(resource, restype):
     '''Returns attributes or price list dict by regions
 
@@ -77,32 +420,36 @@ def get_regions(resource, restype):
     :return: Price list with region as key
     :rtype: dict
     '''
+    return get_catalog(resource, restype)[0]
 
-    models = get_models(resource)
+def refresh_catalog(resource, restype):
+    '''Downloads a price list and stores every region in the local catalog
 
-    for url in models:
-        if restype not in url:
-            continue
-
-        js = requests.get(url)
+    :param str resource: Resource to query, ``ec2`` or ``rds``
+    :param str restype: Resource type (``linux-od``, ``rhel-od`` ...)
 
-        # as of 31/05/2015, format is
-        # od: callback({vers=0.01,config{:{...}});
-        # reserved: callback({config{:{...}},vers:0.01});
-        jregex = re.search('.+config:(\{(.+)\})(\}\);|,vers:0\.0.+)', js.text)
-        if jregex:
-            s = re.sub(r'([a-zA-Z0-9_-]+):', r'"\1":', jregex.group(1))
-            pricelist = json.loads(s)
-            return [r for r in pricelist['regions']]
+    :return: Price list by regions
+    :rtype: list
+    '''
+    text = get_model(resource, restype)
+    if text is None:
+        return []
 
-    return {}
+    return _store_catalog(resource, restype, text)
 
-def get_all_instances(region = None, resource = None, restype = None):
+def get_all_instances(region = None, resource = None, restype = None,
+                      refresh = False):
     '''Returns an array of resource type on region
 
+    Results come from the local catalog unless it is older than its TTL or
+    ``refresh`` is set, in which case the price model is downloaded again
+    and parsed up to the requested region only. When AWS website can't be
+    reached, an outdated catalog entry is used.
+
     :param str region: Region to lookup (``us-west-1`` ...)
     :param str resource: Resource to query, ``ec2`` or ``rds``
     :param str restype: Resource type (``linux-od``, ``rhel-od`` ...)
+    :param bool refresh: Ignore the local catalog
 
     :return prices: Dict containing instances properties and prices per hour
     :rtype: dict
@@ -113,12 +460,167 @@ def get_all_instances(region = None, resource = None, restype = None):
        model: '//a0.awsstatic.com/pricing/1/ec2/linux-od.min.js'
     '''
 
-    pricelist = get_regions(resource, restype)
-    for reg in pricelist:
-        if reg['region'] == region:
+    key = _catalog_key(resource, restype, region)
+    if not refresh:
+        reg = catalog.get(key)
+        if reg is not None:
             return reg
 
-    return None
+    try:
+        text = get_model(resource, restype)
+    except requests.exceptions.RequestException:
+        stale = catalog.entry(key)
+        if stale is None:
+            raise
+        return stale['value']
+
+    if text is None:
+        return None
+
+    # regions parsed on the way are stored too
+    found = None
+    parsed = {}
+    for reg in iter_regions(text):
+        parsed[_catalog_key(resource, restype, reg['region'])] = reg
+        if reg['region'] == region:
+            found = reg
+            break
+    catalog.setmany(parsed, version = model_version(text))
+
+    return found
+
+def get_regions_instances(regions, resource = None, restype = None,
+                          refresh = False):
+    '''Returns the instance lists of many regions, downloading and parsing
+    the price model at most once
+
+    :param list regions: Regions to lookup (``us-west-1`` ...)
+    :param str resource: Resource to query, ``ec2`` or ``rds``
+    :param str restype: Resource type (``linux-od``, ``rhel-od`` ...)
+    :param bool refresh: Ignore the local catalog
+
+    :return: ``get_all_instances`` results by region, regions without any
+             price are absent
+    :rtype: dict
+    '''
+    found = {}
+    if not refresh:
+        for region in regions:
+            reg = catalog.get(_catalog_key(resource, restype, region))
+            if reg is not None:
+                found[region] = reg
+
+    missing = [r for r in regions if not r in found]
+    if not missing:
+        return found
+
+    try:
+        pricelist = refresh_catalog(resource, restype)
+    except requests.exceptions.RequestException:
+        pricelist = []
+        for region in missing:
+            stale = catalog.entry(_catalog_key(resource, restype, region))
+            if stale is None:
+                raise
+            pricelist.append(stale['value'])
+
+    for reg in pricelist:
+        if reg['region'] in missing:
+            found[reg['region']] = reg
+
+    return found
+
+# purchase options as named in instance_price results
+price_options = {
+    'partialUpfront': 'partial',
+    'allUpfront': 'full',
+    'noUpfront': 'noup',
+}
+
+class PriceIndex(object):
+    '''Hash index over a region price list, for repeated lookups
+
+    Instance types attributes and flattened prices are indexed once, so
+    ``instance_price``, ``get_instance_prices`` and ``get_instance_attrs``
+    no longer scan the whole list for every instance. Those functions
+    accept a ``PriceIndex`` in place of the full list.
+
+    :param dict fulllist: Full instance list from ``get_all_instances``
+
+    Typical usage:
+
+       .. code-block:: python
+
+          idx = ap.PriceIndex(fulllist)
+          idx.price('m3.xlarge', 'yrTerm1', 'allUpfront', 'effectiveHourly')
+          ap.instance_price(idx, 'm3.xlarge')
+    '''
+    def __init__(self, fulllist):
+        self.attrs = {}
+        self.terms = {}
+        self.prices = {}
+        self.summary = {}
+
+        for itypes in fulllist['instanceTypes']:
+            for i in itypes.get('sizes', []):
+                self.attrs.setdefault(i['size'], i)
+            if not 'terms' in itypes:
+                continue
+
+            itype = itypes['type']
+            self.terms.setdefault(itype, itypes['terms'])
+            flat = {}
+            summary = {'ondemand': None, 'yrTerm1': {}, 'yrTerm3': {}}
+            for term in itypes['terms']:
+                if summary['ondemand'] is None and 'onDemandHourly' in term:
+                    summary['ondemand'] = \
+                        term['onDemandHourly'][0]['prices']['USD']
+                summary.setdefault(term['term'], {})
+                for option in term['purchaseOptions']:
+                    opt = option['purchaseOption']
+                    for value in option['valueColumns']:
+                        usd = value['prices']['USD']
+                        flat[(term['term'], opt, value['name'])] = usd
+                        if value['name'] != 'effectiveHourly':
+                            continue
+                        # only 1 year terms have a no upfront option
+                        if opt == 'noUpfront' and term['term'] != 'yrTerm1':
+                            continue
+                        if opt in price_options:
+                            summary[term['term']][price_options[opt]] = usd
+            flat['ondemand'] = summary['ondemand']
+            self.prices.setdefault(itype, flat)
+            self.summary.setdefault(itype, summary)
+
+    def instance_attrs(self, itype):
+        '''Returns instance caracteristics, see ``get_instance_attrs``
+        '''
+        return self.attrs.get(itype)
+
+    def instance_terms(self, itype):
+        '''Returns instance terms, see ``get_instance_prices``
+        '''
+        return self.terms.get(itype)
+
+    def price(self, itype, term, option, column):
+        '''Returns a single price
+
+        :param str itype: Instance type
+        :param str term: ``yrTerm1`` or ``yrTerm3``
+        :param str option: Purchase option, like ``partialUpfront``
+        :param str column: Value column, like ``effectiveHourly``
+
+        :return: Price in USD, as found in the price list
+        :rtype: str
+        '''
+        return self.prices.get(itype, {}).get((term, option, column))
+
+    def instance_price(self, itype):
+        '''Returns hourly prices, see ``instance_price``
+        '''
+        if not itype in self.summary:
+            return {'ondemand': None, 'yrTerm1': {}, 'yrTerm3': {}}
+        return self.summary[itype]
 
 def get_instance_attrs(fulllist, itype):
     '''Returns instance price and caracteristics for a given region
@@ -129,6 +631,8 @@ def get_instance_attrs(fulllist, itype):
     :return: Dict of instance caracteristics
     :rtype: dict
     '''
+    if isinstance(fulllist, PriceIndex):
+        return fulllist.instance_attrs(itype)
 
     for itypes in fulllist['instanceTypes']:
         for i in itypes['sizes']:
@@ -145,6 +649,8 @@ def get_instance_prices(fulllist, itype):
     :return: Dict of given instance type price
     :rtype: dict
     '''
+    if isinstance(fulllist, PriceIndex):
+        return fulllist.instance_terms(itype)
 
     inst_type = {}
     for inst_type in fulllist['instanceTypes']:
@@ -187,6 +693,9 @@ def instance_price(fulllist, itype):
     :return: A simple hourly prices dict
     :rtype: dict
     '''
+    if isinstance(fulllist, PriceIndex):
+        return fulllist.instance_price(itype)
+
     prices = fulllist['instanceTypes']
 
     pricelist = {
@@ -216,94 +725,81 @@ def instance_price(fulllist, itype):
                                     value['prices']['USD']
     return pricelist
 
-def prices2csv(fulllist):
+# prices2csv columns: title, term, purchase option and value column
+csv_columns = [
+    ('1y no up', 'yrTerm1', 'noUpfront', 'monthlyStar'),
+    ('1y part up', 'yrTerm1', 'partialUpfront', 'upfront'),
+    ('monthly', 'yrTerm1', 'partialUpfront', 'monthlyStar'),
+    ('3y part up', 'yrTerm3', 'partialUpfront', 'upfront'),
+    ('monthly', 'yrTerm3', 'partialUpfront', 'monthlyStar'),
+]
+
+def iter_prices_csv(fulllist, regions = None, terms = None):
+    '''Yields CSV lines of every instance type price, one column group per
+    region
+
+    Price lists are pivoted in a single pass into a dict keyed by instance
+    type and region, then rows are generated from it.
+
+    :param list fulllist: Full instance by regions list from ``get_regions``
+    :param list regions: Regions to export, all of them if ``None``
+    :param list terms: Terms to export (``yrTerm1``, ``yrTerm3``), all of
+                       them if ``None``
+
+    :return: CSV lines, header first
+    :rtype: generator
+    '''
+    columns = [c for c in csv_columns if terms is None or c[1] in terms]
+
+    types = []
+    seen = set()
+    regnames = []
+    table = {}
+    for region in fulllist:
+        curreg = region['region']
+        if regions is not None and curreg not in regions:
+            continue
+        regnames.append(curreg)
+        prices = PriceIndex(region).prices
+        for itype in sorted(prices):
+            table[(itype, curreg)] = prices[itype]
+            if not itype in seen:
+                seen.add(itype)
+                types.append(itype)
+
+    yield ''.join([
+        ',{0},{1}'.format(r, ','.join([c[0] for c in columns]))
+        for r in regnames
+    ])
+
+    empty = ',' * len(columns)
+    for itype in types:
+        row = [itype]
+        for curreg in regnames:
+            prices = table.get((itype, curreg))
+            if prices is None:
+                row.append('N{0}'.format(empty))
+                continue
+            row.append('Y,{0}'.format(','.join([
+                str(prices.get(c[1:], '')) for c in columns
+            ])))
+        yield ','.join(row)
+
+def prices2csv(fulllist, regions = None, terms = None, path = 'allprices.csv'):
     '''An example function that converts all instances prices to a CSV file
 
     :param str fulllist: Full instance by regions list from ``get_regions``
+    :param list regions: Regions to export, all of them if ``None``
+    :param list terms: Terms to export, all of them if ``None``
+    :param str path: CSV file to write
 
     .. note::
 
-       If may want to modify the ``head`` and ``tmprow`` variables to suit your
-       needs.
+       If may want to modify ``csv_columns`` to suit your needs.
     '''
-
-    typelist = []
-    for region in fulllist:
-        for itype in region['instanceTypes']:
-            if not itype['type'] in typelist:
-                typelist.append(itype['type'])
-
-    def getusd(term, option, duration):
-        # fulllist[x]['instanceTypes'][y]['terms'][z]['purchaseOptions']
-        for opt in term['purchaseOptions']:
-            if opt['purchaseOption'] == option:
-                for vc in opt['valueColumns']:
-                    if vc['name'] == duration:
-                        return vc['prices']['USD']
-
-    regions = []
-    csvarr = []
-    for itype in typelist:
-        row = {'type': itype}
-        # fulllist[x]
-        for region in fulllist:
-            curreg = region['region']
-            regions.append(curreg)
-            row[curreg] = {}
-            row[curreg]['avail'] = False
-            # fulllist[x]['instanceTypes']
-            for family in region['instanceTypes']:
-                if family['type'] == itype:
-                    row[curreg]['avail'] = True
-                    # fulllist[x]['instanceTypes'][y]
-                    for term in family['terms']:
-                        row[curreg][term['term']] = {}
-                        for otype in [
-                            'noUpfront', 'partialUpfront', 'allUpfront'
-                        ]:
-                            row[curreg][term['term']][otype] = {}
-                            for d in [
-                                'upfront', 'monthlyStar'
-                            ]:
-                                row[curreg][term['term']][otype][d] = getusd(
-                                    term, otype, d
-                                )
-
-        csvarr.append(row)
-
-    head = ''
-    for region in regions:
-        head = ','.join([
-            head, '{0},1y no up,1y part up,monthly,3y part up,monthly'
-        ]).format(region)
-
-    f = open('allprices.csv', 'w')
-
-    f.write('{0}\n'.format(head))
-
-    # parse in instance order
-    for itype in typelist:
-        row = itype
-        # then parse in region order
-        for region in regions:
-            for inst in csvarr:
-                if inst['type'] == itype:
-                    if inst[region]['avail'] is False:
-                        tmprow = 'N,,,,,'
-                    else:
-                        ireg = inst[region]
-                        tmprow = 'Y,{0},{1},{2},{3},{4}'.format(
-                            ireg['yrTerm1']['noUpfront']['monthlyStar'],
-                            ireg['yrTerm1']['partialUpfront']['upfront'],
-                            ireg['yrTerm1']['partialUpfront']['monthlyStar'],
-                            ireg['yrTerm3']['partialUpfront']['upfront'],
-                            ireg['yrTerm3']['partialUpfront']['monthlyStar']
-
-                        )
-                    row = ','.join([row, tmprow])
-        f.write('{0}\n'.format(row))
-
-    f.close()
+    with open(path, 'w') as f:
+        for line in iter_prices_csv(fulllist, regions, terms):
+            f.write('{0}\n'.format(line))
 
 
 # Example usage
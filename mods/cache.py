@@ -0,0 +1,193 @@
+'''Small on-disk ``JSON`` cache shared by awstools modules and runs
+
+.. module:: Cache
+   :platform: UNIX
+   :synopsis: Persist slow to compute values between runs
+
+Each cache is a ``JSON`` file in ``$XDG_CACHE_HOME/awstools`` (defaults to
+``~/.cache/awstools``) mapping keys to a value and the time it was stored.
+Entries older than their TTL are ignored by ``get``, but are still available
+through ``entry``, i.e. to work offline or make conditional requests.
+The directory is only resolved when a cache is used and only created when a
+value is first stored, so creating a cache at import time is free.
+
+Caches holding big or many values can be sharded: each entry is then kept
+in its own file under ``$XDG_CACHE_HOME/awstools/<name>/``, so reading or
+storing an entry never loads nor rewrites the others.
+
+Setting the ``AWSTOOLS_REFRESH`` environment variable ignores every entry
+stored before the current process started, forcing a refresh while still
+sharing freshly stored values within the run.
+
+Typical usage:
+
+   .. code-block:: python
+
+      amis = DiskCache('amis', ttl = 3600)
+      ids = amis.get('eu-west-1|debian-*')
+      if ids is None:
+          ids = resolve('debian-*')
+          amis.set('eu-west-1|debian-*', ids)
+'''
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+started = time.time()
+refresh = bool(os.environ.get('AWSTOOLS_REFRESH'))
+
+
+def cachedir():
+    '''Returns awstools cache directory, which may not exist yet
+
+    :rtype: str
+    '''
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'awstools')
+
+
+def _makedirs(path):
+    '''Creates a private directory, unless it already exists
+    '''
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        # another thread or process may have created it meanwhile
+        if not os.path.isdir(path):
+            raise
+
+
+class DiskCache(object):
+    '''DiskCache class constructor
+
+    :param str name: Cache name, used as the file name
+    :param int ttl: Default entries lifetime, in seconds
+    :param str path: Cache file path, or directory when sharded, overrides
+                     ``name``
+    :param bool sharded: Keep every entry in its own file
+    '''
+    def __init__(self, name, ttl = 86400, path = None, sharded = False):
+        self.name = name
+        self.ttl = ttl
+        self.sharded = sharded
+        self._path = path
+        self.lock = threading.Lock()
+        self.data = {} if sharded else None
+
+    @property
+    def path(self):
+        '''Cache file, or directory when sharded, resolved on every access
+        '''
+        if self._path is not None:
+            return self._path
+        return os.path.join(
+            cachedir(),
+            self.name if self.sharded else '{0}.json'.format(self.name)
+        )
+
+    def _shard(self, key):
+        return os.path.join(self.path, '{0}.json'.format(
+            hashlib.sha1(key.encode('utf-8')).hexdigest()
+        ))
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, path, data):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            _makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(prefix = '.', dir = dirname)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def _load(self):
+        if self.data is None:
+            self.data = self._read(self.path) or {}
+        return self.data
+
+    def _entry(self, key):
+        if not self.sharded:
+            return self._load().get(key)
+        if not key in self.data:
+            e = self._read(self._shard(key))
+            # a hash collision is as good as a missing entry
+            self.data[key] = e if e is not None and e['key'] == key else None
+        return self.data[key]
+
+    def entry(self, key):
+        '''Returns a raw entry, even an expired one
+
+        :param str key: Entry key
+
+        :return: Dict with ``time`` and ``value`` keys, plus any metadata
+                 given to ``set``, or ``None``
+        :rtype: dict
+        '''
+        with self.lock:
+            return self._entry(key)
+
+    def get(self, key, ttl = None):
+        '''Returns a fresh value
+
+        :param str key: Entry key
+        :param int ttl: Lifetime, in seconds, overrides the default one
+
+        :return: Cached value or ``None`` if absent or expired
+        '''
+        e = self.entry(key)
+        if e is None:
+            return None
+        if refresh and e['time'] < started:
+            return None
+        if time.time() - e['time'] > (self.ttl if ttl is None else ttl):
+            return None
+        return e['value']
+
+    def set(self, key, value, **meta):
+        '''Stores a value and writes the cache file atomically
+
+        :param str key: Entry key
+        :param value: ``JSON`` serializable value
+        :param meta: Additional metadata kept along with the entry
+        '''
+        self.setmany({key: value}, **meta)
+
+    def setmany(self, values, **meta):
+        '''Stores many values at once, writing the cache file a single time
+
+        :param dict values: Dict of ``key`` / ``value`` pairs
+        :param meta: Additional metadata kept along with every entry
+        '''
+        now = time.time()
+        with self.lock:
+            if self.sharded:
+                for key in values:
+                    e = dict(meta)
+                    e.update({'key': key, 'time': now, 'value': values[key]})
+                    self._write(self._shard(key), e)
+                    self.data[key] = e
+                return
+
+            # merge with what other processes may have stored meanwhile
+            self.data = None
+            data = self._load()
+            for key in values:
+                e = dict(meta)
+                e.update({'time': now, 'value': values[key]})
+                data[key] = e
+            self._write(self.path, data)
@@ -0,0 +1,118 @@
+'''Fleet cost aggregation
+
+.. module:: Cost
+   :platform: UNIX
+   :synopsis: Compute the cost of a fleet of instances for every pricing option
+
+A fleet is a dict of instance counts per instance type. Its cost is computed
+by building a type x pricing option matrix of hourly prices, so totals for
+every option and duration are a couple of matrix products rather than a
+loop over instances. ``numpy`` is used when available, plain python
+otherwise.
+
+Typical usage:
+
+   .. code-block:: python
+
+      idx = ap.PriceIndex(ap.get_all_instances(
+          'eu-west-1', 'ec2', 'ri-v2/linux-unix-shared'
+      ))
+      cost = fleet_cost({'t2.micro': 12, 'm4.large': 3}, idx)
+      cost['totals']['mthly']['ondemand']
+'''
+
+import mods.awsprice as ap
+
+try:
+    import numpy as np
+    np_available = True
+except ImportError:
+    np_available = False
+
+# pricing options: key, title and path in awsprice.instance_price results
+options = [
+    ('ondemand', 'on demand', ('ondemand',)),
+    ('noup', '1 y no up', ('yrTerm1', 'noup')),
+    ('1yearpartup', '1 y part up', ('yrTerm1', 'partial')),
+    ('1yearfullup', '1 y full up', ('yrTerm1', 'full')),
+    ('3yearpartup', '3 y part up', ('yrTerm3', 'partial')),
+    ('3yearfullup', '3 y full up', ('yrTerm3', 'full')),
+]
+
+# durations, in hours
+durations = [
+    ('hrly', 1),
+    ('mthly', 24 * 30.5),
+    ('yrly', 24 * 30.5 * 12),
+]
+
+
+def _hourly(price, path):
+    for p in path:
+        if not isinstance(price, dict) or not p in price:
+            return None
+        price = price[p]
+    return None if price is None else float(price)
+
+
+def price_matrix(types, index):
+    '''Builds the hourly price matrix of instance types
+
+    :param list types: Instance types, matrix rows
+    :param index: ``awsprice.PriceIndex`` or full instance list
+
+    :return: Rows of hourly prices, one column per pricing option, and the
+             list of types having no price
+    :rtype: tuple
+    '''
+    matrix = []
+    missing = []
+    for itype in types:
+        price = ap.instance_price(index, itype)
+        row = [_hourly(price, o[2]) for o in options]
+        if None in row:
+            missing.append(itype)
+            row = [0.0 if p is None else p for p in row]
+        matrix.append(row)
+
+    return matrix, missing
+
+
+def fleet_cost(counts, index):
+    '''Computes a fleet cost for every pricing option and duration
+
+    :param dict counts: Number of instances per instance type
+    :param index: ``awsprice.PriceIndex`` or full instance list
+
+    :return: Dict with ``hourly`` prices and ``totals`` per duration, both
+             keyed by pricing option, plus the ``missing`` types having no
+             known price
+    :rtype: dict
+    '''
+    types = sorted(counts)
+    matrix, missing = price_matrix(types, index)
+    hours = [d[1] for d in durations]
+
+    if np_available and types:
+        hourly = np.dot(
+            np.array([counts[t] for t in types], dtype = float),
+            np.array(matrix, dtype = float)
+        )
+        table = np.outer(np.array(hours), hourly).tolist()
+        hourly = hourly.tolist()
+    else:
+        hourly = [
+            sum(counts[t] * row[i] for t, row in zip(types, matrix))
+            for i in range(len(options))
+        ]
+        table = [[h * p for p in hourly] for h in hours]
+
+    keys = [o[0] for o in options]
+    return {
+        'hourly': dict(zip(keys, [round(p, 5) for p in hourly])),
+        'totals': dict(
+            (d[0], dict(zip(keys, [round(p, 5) for p in row])))
+            for d, row in zip(durations, table)
+        ),
+        'missing': missing,
+    }
@@ -0,0 +1,203 @@
+'''Crash-safe state journal for ``yaml`` infrastructure descriptions
+
+.. module:: Journal
+   :platform: UNIX
+   :synopsis: Record created resources without rewriting the description
+
+Rather than dumping the whole description file after every change, each
+change is appended as a single ``JSON`` line to a ``<description>.journal``
+file and ``fsync``-ed. Once the journal grows bigger than the description
+was when last written, and when the journal is closed, the description is
+rewritten to a temporary file which atomically replaces the original, and
+the journal records it contains are dropped. As the description is only
+rewritten when the journal doubles its size, a whole run stays linear. A
+run which recorded nothing leaves the description untouched, along with its
+comments and formatting.
+
+Compaction happens outside of the lock records are written with: the
+journal is rotated to ``<description>.journal.1`` and the description copied
+under the lock, then written out while other threads keep recording.
+
+A journal left behind by an interrupted run is replayed when the next run
+opens it, so no recorded resource is ever lost.
+
+Typical usage:
+
+   .. code-block:: python
+
+      journal = Journal('infra.yaml', y)
+      journal.record(instance, {'awsid': 'i-1234'})
+      journal.close()
+'''
+
+import os
+import copy
+import json
+import yaml
+import tempfile
+import threading
+
+
+class Journal(object):
+    '''Journal class constructor, replays any leftover journal
+
+    :param str yf: Path to the ``yaml`` description
+    :param dict y: Loaded description
+    :param int minsize: Never compact a journal smaller than that, in bytes
+    '''
+    def __init__(self, yf, y, minsize = 4096):
+        self.yf = yf
+        self.y = y
+        self.minsize = minsize
+        self.path = '{0}.journal'.format(yf)
+        self.rotated = '{0}.1'.format(self.path)
+        # protects the description and the journal file
+        self.lock = threading.Lock()
+        # only one compaction at a time
+        self.compact_lock = threading.Lock()
+        self.size = 0
+        self.threshold = minsize
+        # something was recorded since the description was last written
+        self.dirty = False
+
+        # instances are identified by region and name
+        self.keys = {}
+        self.instances = {}
+        for reg in y:
+            for azlst in y[reg]:
+                for az in azlst:
+                    if not isinstance(azlst[az], list):
+                        continue
+                    for instance in azlst[az]:
+                        key = '{0}/{1}'.format(reg, instance['name'])
+                        self.keys[id(instance)] = key
+                        self.instances[key] = instance
+
+        if os.path.exists(self.yf):
+            self.threshold = max(minsize, os.path.getsize(self.yf))
+
+        self.fd = None
+        if self.replay():
+            self.compact()
+        if self.fd is None:
+            self.fd = open(self.path, 'a')
+            self.size = self.fd.tell()
+
+    def replay(self):
+        '''Applies records left by a previous run to the description
+
+        :return: Number of replayed records
+        :rtype: int
+        '''
+        count = 0
+        # a rotated journal holds the oldest records
+        for path in (self.rotated, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # last record was being written when we died
+                        break
+                    if rec['key'] in self.instances:
+                        self.instances[rec['key']].update(rec['state'])
+                        count += 1
+
+        return count
+
+    def record(self, instance, state):
+        '''Durably records a new state for an instance
+
+        :param dict instance: Instance informations, from the description
+        :param dict state: Keys to add or update, like ``awsid``
+        '''
+        line = '{0}\n'.format(
+            json.dumps({'key': self.keys[id(instance)], 'state': state})
+        )
+        with self.lock:
+            instance.update(state)
+            self.dirty = True
+            self.fd.write(line)
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+            self.size += len(line)
+            full = self.size > self.threshold
+
+        # someone else compacting is as good as us doing it
+        if full and self.compact_lock.acquire(False):
+            try:
+                self._compact()
+            finally:
+                self.compact_lock.release()
+
+    def compact(self):
+        '''Rewrites the description with every record and empties the journal
+        '''
+        with self.compact_lock:
+            self._compact()
+
+    def _rotate(self):
+        # called with the lock held, records go to a new journal from now on
+        if self.fd is not None:
+            self.fd.close()
+        if os.path.exists(self.rotated) and os.path.exists(self.path):
+            # a previous compaction failed, keep its records too
+            with open(self.rotated, 'a') as r:
+                with open(self.path, 'r') as f:
+                    r.write(f.read())
+                r.flush()
+                os.fsync(r.fileno())
+            os.unlink(self.path)
+        elif os.path.exists(self.path):
+            os.rename(self.path, self.rotated)
+        self.fd = open(self.path, 'w')
+        self.size = 0
+        self.dirty = False
+        return copy.deepcopy(self.y)
+
+    def _compact(self):
+        with self.lock:
+            y = self._rotate()
+
+        dirname = os.path.dirname(os.path.abspath(self.yf))
+        fd, tmp = tempfile.mkstemp(prefix = '.', dir = dirname)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                yaml.safe_dump(y, f, default_flow_style=False)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            if os.path.exists(self.yf):
+                os.chmod(tmp, os.stat(self.yf).st_mode & 0o777)
+            os.rename(tmp, self.yf)
+        except Exception:
+            os.unlink(tmp)
+            with self.lock:
+                self.dirty = True
+            raise
+
+        dfd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+
+        # rotated records are now part of the description
+        if os.path.exists(self.rotated):
+            os.unlink(self.rotated)
+
+        with self.lock:
+            self.threshold = max(self.minsize, size)
+
+    def close(self):
+        '''Compacts the journal for the last time, if anything was recorded,
+        and removes it
+        '''
+        with self.compact_lock:
+            if self.dirty or os.path.exists(self.rotated):
+                self._compact()
+            with self.lock:
+                self.fd.close()
+                os.unlink(self.path)
@@ -0,0 +1,240 @@
+'''Dependency aware parallel job runner
+
+.. module:: Scheduler
+   :platform: UNIX
+   :synopsis: Run a graph of jobs on a bounded pool of worker threads
+
+Jobs are added along with the jobs they depend on, and a job only starts
+once all of its dependencies succeeded. Independent jobs run concurrently on
+at most ``jobs`` worker threads. When a job fails, every job depending on it,
+directly or not, is skipped while unrelated jobs keep running. A job calling
+``sys.exit`` fails like any other, without stopping the run.
+
+Only as many jobs as there are workers are handed to the pool, the others
+wait for a free worker. An interruption, be it ``Ctrl-C`` or a job raising
+``KeyboardInterrupt``, stops the run: running jobs are waited for, but no
+other job is started.
+
+Whatever a job prints is buffered and written out in the order jobs were
+added, so the output of a run does not depend on thread timing.
+
+Typical usage:
+
+   .. code-block:: python
+
+      sched = Scheduler(8)
+      sched.add('net', mknet)
+      sched.add('vm1', mkvm, ('vm1',), deps = ['net'])
+      sched.add('vm2', mkvm, ('vm2',), deps = ['net'])
+      failed = sched.run()
+'''
+
+import sys
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    _input = raw_input
+except NameError:
+    _input = input
+
+# serializes interactive questions asked from jobs
+_prompt_lock = threading.Lock()
+
+
+class _Output(object):
+    '''``sys.stdout`` proxy buffering writes coming from job threads
+
+    :param stream: Real output stream
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buf = getattr(self.local, 'buf', None)
+        if buf is None:
+            self.stream.write(data)
+        else:
+            buf.append(data)
+
+    def flush(self):
+        if getattr(self.local, 'buf', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def prompt(question):
+    '''Asks a question on the terminal, even from within a running job
+
+    The calling job buffered output is written first so the question keeps
+    its context, and only one question is asked at a time.
+
+    :param str question: Question to ask
+
+    :return: User reply
+    :rtype: str
+    '''
+    with _prompt_lock:
+        out = sys.stdout
+        if not isinstance(out, _Output):
+            return _input(question)
+
+        buf = getattr(out.local, 'buf', None)
+        out.local.buf = None
+        try:
+            if buf:
+                out.stream.write(''.join(buf))
+                del buf[:]
+            return _input(question)
+        finally:
+            out.local.buf = buf
+
+
+class Scheduler(object):
+    '''Scheduler class constructor
+
+    :param int jobs: Maximum number of jobs running at the same time
+    '''
+    def __init__(self, jobs = 4):
+        self.jobs = max(1, jobs)
+        self.order = []
+        self.nodes = {}
+
+    def add(self, key, func, args = (), deps = ()):
+        '''Adds a job to the graph
+
+        :param str key: Unique job name
+        :param func: Callable to run
+        :param tuple args: Arguments given to ``func``
+        :param list deps: Names of previously added jobs this one waits for
+        '''
+        if key in self.nodes:
+            raise ValueError('job {0} already scheduled'.format(key))
+        for d in deps:
+            if d not in self.nodes:
+                raise ValueError('{0} depends on unknown job {1}'.format(key, d))
+
+        self.nodes[key] = {
+            'func': func,
+            'args': args,
+            'deps': set(deps),
+            'children': [],
+        }
+        for d in set(deps):
+            self.nodes[d]['children'].append(key)
+        self.order.append(key)
+
+    def __contains__(self, key):
+        return key in self.nodes
+
+    def run(self):
+        '''Runs every job, honoring dependencies
+
+        :return: Failed or skipped jobs with the corresponding error
+        :rtype: dict
+        '''
+        out = _Output(sys.stdout)
+        done = queue.Queue()
+        waiting = dict((k, set(self.nodes[k]['deps'])) for k in self.order)
+        # jobs whose dependencies are met, waiting for a free worker
+        ready = []
+        output = {}
+        failed = {}
+        running = [0]
+
+        def _exec(key):
+            node = self.nodes[key]
+            buf = []
+            out.local.buf = buf
+            try:
+                node['func'](*node['args'])
+                err = None
+            except KeyboardInterrupt:
+                # stops the whole run, see below
+                err = sys.exc_info()[1]
+            except SystemExit:
+                # a job giving up already said why
+                err = sys.exc_info()[1]
+                buf.append('{0} aborted\n'.format(key))
+            except BaseException:
+                err = sys.exc_info()[1]
+                buf.append(traceback.format_exc())
+            finally:
+                out.local.buf = None
+            done.put((key, err, buf))
+
+        pool = ThreadPool(self.jobs)
+
+        def _ready(key):
+            del waiting[key]
+            ready.append(key)
+
+        def _submit():
+            while ready and running[0] < self.jobs:
+                running[0] += 1
+                pool.apply_async(_exec, (ready.pop(0),))
+
+        def _skip(key, cause):
+            if key not in waiting:
+                return
+            del waiting[key]
+            failed[key] = cause
+            output[key] = ['skipping {0}: {1} failed\n'.format(key, cause)]
+            for child in self.nodes[key]['children']:
+                _skip(child, key)
+
+        sys.stdout = out
+        interrupted = True
+        try:
+            for key in self.order:
+                if key in waiting and not waiting[key]:
+                    _ready(key)
+            _submit()
+
+            emitted = 0
+            while running[0]:
+                try:
+                    key, err, buf = done.get(True, 1)
+                except queue.Empty:
+                    continue
+                running[0] -= 1
+                output[key] = buf
+                if isinstance(err, KeyboardInterrupt):
+                    raise err
+                if err is not None:
+                    failed[key] = err
+                    for child in self.nodes[key]['children']:
+                        _skip(child, key)
+                else:
+                    for child in self.nodes[key]['children']:
+                        if child in waiting:
+                            waiting[child].discard(key)
+                            if not waiting[child]:
+                                _ready(child)
+                _submit()
+
+                while (emitted < len(self.order) and
+                       self.order[emitted] in output):
+                    out.stream.write(''.join(output.pop(self.order[emitted])))
+                    out.stream.flush()
+                    emitted += 1
+            interrupted = False
+        finally:
+            sys.stdout = out.stream
+            if interrupted:
+                # nothing is queued, only wait for running jobs
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+        return failed
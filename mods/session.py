@@ -10,32 +10,531 @@
 .. _boto3: http://boto3.readthedocs.org/en/latest/
 '''
 
+import io
+import time
+import gzip
 import boto3
+import boto3.exceptions
+import string
+import threading
 import base64
+import random
 import requests
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from multiprocessing.pool import ThreadPool
+from botocore.exceptions import ClientError
+from mods.cache import DiskCache
 
-class Aws:
+
+class WaiterTimeout(Exception):
+    '''Raised when ``waiter`` gives up on a resource
+    '''
+    pass
+
+
+def notfound(e):
+    '''Tells if an exception is an AWS ``*.NotFound`` error, which is what
+    eventually consistent APIs return for freshly created resources
+
+    :param Exception e: Exception to check
+
+    :rtype: bool
+    '''
+    if not isinstance(e, ClientError):
+        return False
+    code = e.response.get('Error', {}).get('Code', '')
+    return code.endswith('NotFound')
+
+
+def throttled(e):
+    '''Tells if an exception is AWS asking to slow down, or route53 still
+    applying a previous change
+
+    :param Exception e: Exception to check
+
+    :rtype: bool
+    '''
+    if not isinstance(e, ClientError):
+        return False
+    code = e.response.get('Error', {}).get('Code', '')
+    return code in (
+        'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+        'PriorRequestNotComplete'
+    )
+
+
+def waiter(func, args = (), kwargs = None, until = None, retry = notfound,
+           timeout = 60, base = 0.5, cap = 8):
+    '''Calls ``func`` until it succeeds, backing off exponentially
+
+    ``func`` is called again when it raises an exception accepted by
+    ``retry`` or returns a value refused by ``until``. Delays between calls
+    are drawn at random between 0 and ``min(cap, base * 2 ** attempt)``.
+
+    :param func: Callable to wait for
+    :param tuple args: Positional arguments for ``func``
+    :param dict kwargs: Keyword arguments for ``func``
+    :param until: Predicate accepting ``func`` return value, any by default
+    :param retry: Predicate telling which exceptions are worth a retry
+    :param int timeout: Give up after that many seconds
+    :param float base: First delay upper bound, in seconds
+    :param float cap: Delay upper bound, in seconds
+
+    :return: ``func`` return value
+    :raises WaiterTimeout: When ``timeout`` is reached
+    '''
+    kwargs = kwargs or {}
+    deadline = time.time() + timeout
+    attempt = 0
+    while True:
+        try:
+            ret = func(*args, **kwargs)
+            if until is None or until(ret):
+                return ret
+            why = 'not ready'
+        except Exception as e:
+            if not retry(e):
+                raise
+            why = e
+
+        delay = random.uniform(0, min(cap, base * 2 ** attempt))
+        if time.time() + delay > deadline:
+            raise WaiterTimeout('gave up after {0}s: {1}'.format(timeout, why))
+        time.sleep(delay)
+        attempt += 1
+
+
+def profiles():
+    '''Returns every profile configured for awscli / boto3
+
+    :rtype: list
+    '''
+    return boto3.Session().available_profiles
+
+
+# resolved AMIs are kept on disk for a day, see mods.cache for forced refresh
+amicache = DiskCache('amis', ttl = 86400)
+# one lock per AMI cache key, so each lookup is made once without blocking
+# unrelated ones
+_amilocks = {}
+_amilocks_lock = threading.Lock()
+
+
+def _amilock(key):
+    with _amilocks_lock:
+        return _amilocks.setdefault(key, threading.Lock())
+
+
+# EC2 user data size limit, before base64 encoding
+MAXUSERDATA = 16384
+
+# cloud-init part types, by first line prefix
+cloudinit_types = [
+    ('#!', 'x-shellscript'),
+    ('#cloud-config', 'cloud-config'),
+    ('#include', 'x-include-url'),
+    ('#cloud-boothook', 'cloud-boothook'),
+    ('#part-handler', 'part-handler'),
+    ('#upstart-job', 'upstart-job'),
+]
+
+
+class Template(object):
+    '''Userdata template, read and parsed once, rendered many times
+
+    Fields are the ``str.format`` ones and render the same. A template can
+    carry on the automatic field numbering of a previous one, like when
+    their texts are formatted as a whole: multipart userdata parts are
+    numbered as if their files were merged.
+
+    :param str text: Template text
+    :param after: ``Template`` to carry on numbering from
+    :raises ValueError: When automatic and manual numbering are mixed
+    '''
+    _formatter = string.Formatter()
+
+    def __init__(self, text, after = None):
+        self.text = text
+        self.auto = after.auto if after is not None else 0
+        self.manual = after.manual if after is not None else False
+        self.chunks = self._parse(text)
+
+    def _parse(self, text):
+        chunks = []
+        for literal, field, spec, conv in self._formatter.parse(text):
+            if literal:
+                chunks.append(literal)
+            if field is None:
+                continue
+            # only the first part of {0.attr} or {0[key]} is numbered
+            head = field
+            for sep in '.[':
+                head = head.split(sep, 1)[0]
+            if head == '':
+                if self.manual:
+                    raise ValueError('cannot switch from manual field '
+                        'specification to automatic field numbering')
+                field = '{0}{1}'.format(self.auto, field)
+                self.auto += 1
+            elif self.auto:
+                raise ValueError('cannot switch from automatic field '
+                    'numbering to manual field specification')
+            else:
+                self.manual = True
+            # nested fields, like {0:{1}}, are numbered after their field
+            chunks.append((
+                field, conv, self._parse(spec) if '{' in spec else spec
+            ))
+        return chunks
+
+    def _render(self, chunks, args):
+        out = []
+        for c in chunks:
+            if not isinstance(c, tuple):
+                out.append(c)
+                continue
+            field, conv, spec = c
+            value = self._formatter.get_field(field, args, {})[0]
+            if conv:
+                value = self._formatter.convert_field(value, conv)
+            if isinstance(spec, list):
+                spec = self._render(spec, args)
+            out.append(format(value, spec))
+        return ''.join(out)
+
+    def render(self, *args):
+        '''Renders the template, like ``text.format(*args)``
+
+        :rtype: str
+        '''
+        return self._render(self.chunks, args)
+
+
+# userdata templates, by file list
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def userdata_parts(userdata):
+    '''Returns the templates of a list of userdata files, reading them once
+    per run
+
+    Consecutive files without a cloud-init header are parts of the same
+    script, like when they are merged, so they share a template. Parts
+    number ``{}`` fields on from the previous ones, so each file renders
+    the same whatever the userdata format.
+
+    :param list userdata: A list of userdata files
+
+    :return: Template of the merged files, and ``(content type, Template)``
+             tuples of the cloud-init parts
+    :rtype: tuple
+    '''
+    key = tuple(userdata)
+    with _templates_lock:
+        if key in _templates:
+            return _templates[key]
+
+        texts = []
+        parts = []
+        for u in userdata:
+            with open('userdata/{0}'.format(u), 'r') as f:
+                text = f.read()
+            texts.append(text)
+            ctype = None
+            for prefix, t in cloudinit_types:
+                if text.startswith(prefix):
+                    ctype = t
+                    break
+            if ctype is None and parts:
+                parts[-1][1] += text
+            else:
+                parts.append([ctype or 'x-shellscript', text])
+
+        templates = []
+        for ctype, text in parts:
+            after = templates[-1][1] if templates else None
+            templates.append((ctype, Template(text, after)))
+        _templates[key] = (Template(''.join(texts)), templates)
+        return _templates[key]
+
+
+def _bytes(data):
+    return data if isinstance(data, bytes) else data.encode('utf-8')
+
+
+def gzip_bytes(data):
+    '''Compresses data, reproducibly
+
+    :param bytes data: Data to compress
+
+    :rtype: bytes
+    '''
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj = buf, mode = 'wb', mtime = 0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+# CreateTags accepts up to 1000 resource ids per call
+MAXTAGRES = 1000
+
+
+class TagBatch(object):
+    '''Accumulates tags to apply them with as few ``CreateTags`` as possible
+
+    Resources sharing a tag are tagged together, and tags shared by the same
+    set of resources go in the same call, so tags common to many resources
+    cost a handful of calls instead of one per resource and key. A tag value
+    unique to a resource, like a ``Name``, still costs one call per resource
+    as ``CreateTags`` applies the same tags to every resource it is given.
+
+    :param aws: ``Aws`` EC2 object used to create tags
+    '''
+    def __init__(self, aws):
+        self.aws = aws
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, rid, taglst):
+        '''Queues tags for a resource
+
+        :param str rid: Resource id
+        :param dict taglst: A dict of key / value pairs
+        '''
+        with self.lock:
+            for k in taglst:
+                self.pending.setdefault((k, taglst[k]), set()).add(rid)
+
+    def flush(self):
+        '''Creates every queued tag
+
+        :return: Number of ``CreateTags`` calls made
+        :rtype: int
+        '''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        # group tags applying to the exact same resources
+        groups = {}
+        for tag in pending:
+            groups.setdefault(frozenset(pending[tag]), {})[tag[0]] = tag[1]
+
+        calls = 0
+        for rids in sorted(groups, key = sorted):
+            rids = sorted(rids)
+            for i in range(0, len(rids), MAXTAGRES):
+                waiter(self.aws.client.create_tags, kwargs = {
+                    'Resources': rids[i:i + MAXTAGRES],
+                    'Tags': self.aws.mktags(groups[frozenset(rids)])
+                })
+                calls += 1
+
+        return calls
+
+
+# ChangeResourceRecordSets limits, UPSERT changes count twice
+MAXRRCHANGES = 1000
+MAXRRCHARS = 32000
+
+
+class DnsBatch(object):
+    '''Accumulates route53 record changes to submit them per hosted zone,
+    in as few ``ChangeResourceRecordSets`` calls as the API limits allow
+
+    :param aws: ``Aws`` route53 object
+    '''
+    def __init__(self, aws):
+        self.aws = aws
+        self.pending = {}
+        self.zones = []
+        self.lock = threading.Lock()
+
+    def add(self, action, dnsrecord):
+        '''Queues a record change
+
+        :param str action: One of ``CREATE``, ``DELETE`` or ``UPSERT``
+        :param dict dnsrecord: DNS record, as in ``Aws.change_nsrecord``
+        '''
+        change = self.aws.mkchange(action, dnsrecord)
+        with self.lock:
+            if not dnsrecord['zone'] in self.pending:
+                self.zones.append(dnsrecord['zone'])
+            self.pending.setdefault(dnsrecord['zone'], []).append(change)
+
+    @staticmethod
+    def _weight(change):
+        rrset = change['ResourceRecordSet']
+        values = [r['Value'] for r in rrset.get('ResourceRecords', [])]
+        n = 2 if change['Action'] == 'UPSERT' else 1
+        return n * max(1, len(values)), n * sum(len(v) for v in values)
+
+    def batches(self, changes):
+        '''Splits changes in batches honoring the API limits
+
+        :param list changes: ``Changes`` items
+
+        :rtype: list
+        '''
+        batches = []
+        count = chars = 0
+        for change in changes:
+            c, l = self._weight(change)
+            if not batches or count + c > MAXRRCHANGES or \
+                chars + l > MAXRRCHARS:
+                batches.append([])
+                count = chars = 0
+            batches[-1].append(change)
+            count += c
+            chars += l
+        return batches
+
+    def flush(self, wait = False, timeout = 300):
+        '''Submits every queued change
+
+        :param bool wait: Wait for every change to be ``INSYNC``
+        :param int timeout: Give up waiting after that many seconds
+
+        :return: Submitted change ids
+        :rtype: list
+        '''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            zones, self.zones = self.zones, []
+
+        ids = []
+        for zone in zones:
+            zoneid = self.aws.zoneid(zone)
+            for changes in self.batches(pending[zone]):
+                comment = '{0} change(s) / {1}'.format(len(changes), zone)
+                ids.append(self.aws.submit_changes(zoneid, changes, comment))
+
+        if wait:
+            self.aws.wait_changes(ids, timeout)
+
+        return ids
+
+
+# resources indexed by Name tag: describe call, result key, id key and
+# resource class
+nametag_res = {
+    'subnets': ('describe_subnets', 'Subnets', 'SubnetId', 'Subnet'),
+    'route_tables': (
+        'describe_route_tables', 'RouteTables', 'RouteTableId', 'RouteTable'
+    ),
+    'security_groups': (
+        'describe_security_groups', 'SecurityGroups', 'GroupId',
+        'SecurityGroup'
+    ),
+    'vpcs': ('describe_vpcs', 'Vpcs', 'VpcId', 'Vpc'),
+}
+
+
+# process-wide boto3 objects: sessions by profile, clients by (profile,
+# service); resources are not thread safe, each thread has its own, by
+# (profile, service) too
+_sessions = {}
+_clients = {}
+_resources = threading.local()
+_registry_lock = threading.RLock()
+
+
+def get_session(profile):
+    '''Returns the shared ``boto3`` session of a profile, creating it once
+
+    :param str profile: Profile, as defined in awscli configuration
+
+    :rtype: boto3.Session
+    '''
+    with _registry_lock:
+        if profile not in _sessions:
+            _sessions[profile] = boto3.Session(profile_name=profile)
+        return _sessions[profile]
+
+
+def get_client(profile, service):
+    '''Returns the shared client of a service, creating it once
+
+    :param str profile: Profile, as defined in awscli configuration
+    :param str service: Service name, like ``ec2`` or ``rds``
+    '''
+    key = (profile, service)
+    with _registry_lock:
+        if key not in _clients:
+            _clients[key] = get_session(profile).client(service)
+        return _clients[key]
+
+
+def get_resource(profile, service):
+    '''Returns the calling thread resource of a service, creating it once
+
+    :param str profile: Profile, as defined in awscli configuration
+    :param str service: Service name, like ``ec2`` or ``s3``
+
+    :raises AttributeError: When the service has no resource interface
+    '''
+    key = (profile, service)
+    resources = getattr(_resources, 'registry', None)
+    if resources is None:
+        resources = _resources.registry = {}
+    if key not in resources:
+        session = get_session(profile)
+        # creating a resource loads models through the shared session
+        with _registry_lock:
+            try:
+                resources[key] = session.resource(service)
+            except boto3.exceptions.ResourceNotExistsError:
+                raise AttributeError(
+                    '{0} has no resource interface'.format(service)
+                )
+    return resources[key]
+
+
+class Aws(object):
     '''Aws class constructor
 
     :param str profile: Region profile, as defined in awscli configuration
     :param str t: Resource type, like ``ec2``, ``cloudformation``...
 
     :return: Access to resource, client and helpers
+
+    .. note::
+
+       ``client`` and ``resource`` are only built when first accessed, so
+       merely instanciating this class does not load any service model. The
+       client is shared by every ``Aws`` object of the same profile and
+       service, and so is the resource within a thread.
     '''
     def __init__(self, profile, t):
         '''Init method
         '''
         self.profile = profile
+        self.t = t
+        self._client = None
+        self._nametags = {}
+        self._zones = {}
+        self._lock = threading.RLock()
         if profile:
-            self.session = boto3.Session(profile_name=profile)
+            self.session = get_session(profile)
             self.region = self.session._session.get_config_variable('region')
-        if t:
-            self.client = self.session.client(t)
-            # some objects don't have resource (i.e. route53)
-            try:
-                self.resource = self.session.resource(t)
-            except:
-                pass
+
+    @property
+    def client(self):
+        '''Service client, created on first access
+        '''
+        if self._client is None:
+            self._client = get_client(self.profile, self.t)
+        return self._client
+
+    @property
+    def resource(self):
+        '''Service resource of the calling thread, created on first access
+
+        Some objects don't have resource (i.e. route53), ``AttributeError`` is
+        raised for those.
+        '''
+        return get_resource(self.profile, self.t)
 
     def lsinstances(self, obj):
         '''Get all instances objects
@@ -58,6 +557,17 @@ class Aws:
             tags.append({'Key': t, 'Value': taglst[t]})
         return tags
 
+    def tagspec(self, restype, taglst):
+        '''Makes a ``TagSpecifications`` entry, to tag resources on creation
+
+        :param str restype: Resource type, like ``instance`` or ``volume``
+        :param dict taglst: A dict of key / value pairs
+
+        :return: ``TagSpecifications`` list item
+        :rtype: dict
+        '''
+        return {'ResourceType': restype, 'Tags': self.mktags(taglst)}
+
     def tags2dict(self, tags):
         '''Converts a Filter tag list to a dict
 
@@ -71,6 +581,77 @@ class Aws:
             ret[t['Key']] = t['Value']
         return ret
 
+    def nametag_index(self, res):
+        '''Returns the Name tag to id index of a resource type, building it
+        with a single paginated describe call on first use
+
+        :param str res: One of ``nametag_res`` keys, like ``subnets``
+
+        :return: Dict of ``key`` = ``Name tag`` / ``value`` = ``id``
+        :rtype: dict
+        '''
+        with self._lock:
+            if res in self._nametags:
+                return self._nametags[res]
+
+            call, key, _, _ = nametag_res[res]
+            kwargs = {'Filters': [{'Name': 'tag-key', 'Values': ['Name']}]}
+            if self.client.can_paginate(call):
+                pages = self.client.get_paginator(call).paginate(**kwargs)
+            else:
+                pages = [getattr(self.client, call)(**kwargs)]
+
+            return self.index_nametags(
+                res, [o for page in pages for o in page[key]]
+            )
+
+    def index_nametags(self, res, objs):
+        '''Builds the Name tag index of a resource type from an already made
+        describe call, unless it is already built
+
+        :param str res: One of ``nametag_res`` keys, like ``subnets``
+        :param list objs: Every object of that type, as described by the API
+
+        :return: Dict of ``key`` = ``Name tag`` / ``value`` = ``id``
+        :rtype: dict
+        '''
+        idkey = nametag_res[res][2]
+        with self._lock:
+            if res in self._nametags:
+                return self._nametags[res]
+
+            index = {}
+            for o in objs:
+                name = self.tags2dict(o.get('Tags', [])).get('Name')
+                # keep the first match, like a filtered lookup would
+                if name is not None and name not in index:
+                    index[name] = o[idkey]
+
+            self._nametags[res] = index
+            return index
+
+    def remember_nametag(self, res, tag, rid):
+        '''Records a resource created by ourselves in the Name tag index
+
+        :param str res: Resource type, like ``subnets``
+        :param str tag: The Name tag
+        :param str rid: Resource id
+        '''
+        with self._lock:
+            if res in self._nametags:
+                self._nametags[res].setdefault(tag, rid)
+
+    def forget_nametags(self, res = None):
+        '''Invalidates the Name tag index
+
+        :param str res: Resource type to forget, every type if ``None``
+        '''
+        with self._lock:
+            if res is None:
+                self._nametags.clear()
+            else:
+                self._nametags.pop(res, None)
+
     def get_id_from_nametag(self, res, tag):
         '''Returns a resource id matching a Name tag
 
@@ -79,33 +660,127 @@ class Aws:
 
         :return: Resource id
         '''
+        if res in nametag_res:
+            return self.nametag_index(res).get(tag)
+
         for o in getattr(self.resource, res).filter(
             Filters=[{'Name': 'tag:Name', 'Values': [tag]}]
         ):
             return o.id
-    
+
         return None
 
-    def mkuserdata(self, b64 = False, userdata = [], name = '', netblock = ''):
+    def get_obj_from_nametag(self, res, tag):
+        '''Returns a resource object matching a Name tag
+
+        :param str res: The resource to get the object from
+        :param str tag: The Name tag
+
+        :return: Resource object or ``None``
+        '''
+        if res in nametag_res:
+            rid = self.nametag_index(res).get(tag)
+            if rid is None:
+                return None
+            return getattr(self.resource, nametag_res[res][3])(rid)
+
+        for o in getattr(self.resource, res).filter(
+            Filters=[{'Name': 'tag:Name', 'Values': [tag]}]
+        ):
+            return o
+
+        return None
+
+    def mksg(self, vpc, rule):
+        '''Returns a Security Group, creating it if it does not exist yet
+
+        :param vpc: VPC resource the Security Group belongs to
+        :param rule: Security Group Name tag, or a dict describing it
+
+        .. code-block:: python
+
+           rule = {
+               'name': 'MySQL_from_client_infra-test',
+               'tag': 'mysql-from-infra-test',
+               'cidr': ['10.0.1.0/24', '192.168.1.0/24'],
+               'port': 3306,
+               'proto': 'tcp'
+           }
+
+        :return: Security Group resource
+        '''
+        if not isinstance(rule, dict):
+            return self.get_obj_from_nametag('security_groups', rule)
+
+        sg = self.get_obj_from_nametag('security_groups', rule['tag'])
+        if sg:
+            return sg
+
+        sg = vpc.create_security_group(
+            GroupName = rule['name'],
+            Description = rule['name'],
+            TagSpecifications = [
+                self.tagspec('security-group', {'Name': rule['tag']})
+            ]
+        )
+        self.remember_nametag('security_groups', rule['tag'], sg.id)
+
+        sg.authorize_ingress(IpPermissions = [{
+            'IpProtocol': rule['proto'],
+            'FromPort': rule['port'],
+            'ToPort': rule['port'],
+            'IpRanges': [{'CidrIp': c} for c in rule['cidr']]
+        }])
+
+        return sg
+
+    def mkuserdata(self, b64 = False, userdata = [], name = '', netblock = '',
+                   fmt = 'raw'):
         '''Merge userdata files and possibly convert it to ``base64``
 
+        Files are read and parsed once per run, and only rendered for each
+        instance. Userdata can be a single script or a cloud-init multipart
+        payload, possibly ``gzip`` compressed to fit EC2 16KB limit.
+
         :param boolean b64: Should we convert userdata to ``base64``
         :param list userdata: A list of userdata files
         :param str name: Name to be passed as an argument to userdata
         :param str netblock: Netblock (CIDR) argument for userdata
+        :param str fmt: One of ``raw`` (merged files), ``multipart``
+                        (cloud-init MIME multipart) or ``gzip`` (compressed
+                        multipart)
 
         :return: Merged userdata files, possibly in ``base64``
         :rtype: str
+        :raises ValueError: When userdata is over EC2 size limit
         '''
-        sh = ''
-        for u in userdata:
-            with open('userdata/{0}'.format(u), 'r') as f:
-                sh = sh + f.read()
-        sh = sh.format(self.profile, name.lower(), netblock)
+        args = (self.profile, name.lower(), netblock)
+        merged, parts = userdata_parts(userdata)
+
+        if fmt == 'raw':
+            data = merged.render(*args)
+        elif fmt in ('multipart', 'gzip'):
+            mime = MIMEMultipart()
+            for ctype, t in parts:
+                mime.attach(MIMEText(t.render(*args), ctype))
+            data = mime.as_string()
+            if fmt == 'gzip':
+                data = gzip_bytes(_bytes(data))
+        else:
+            raise ValueError('unknown userdata format {0}'.format(fmt))
+
+        if len(_bytes(data)) > MAXUSERDATA:
+            raise ValueError(
+                '{0} userdata is {1} bytes, over the {2} bytes limit{3}'.format(
+                    name, len(_bytes(data)), MAXUSERDATA,
+                    ', try the gzip format' if fmt != 'gzip' else ''
+                )
+            )
+
         if b64 is False:
-            return sh
+            return data
         else:
-            return base64.b64encode(sh)
+            return base64.b64encode(_bytes(data))
 
     def gettagval(self, res, tag):
         '''Returns a tag value for a given resource
@@ -122,18 +797,19 @@ class Aws:
         return 'none'
 
     def create_tag(self, rid, k, v):
-        '''Creates a tag entry for a given resource
+        '''Creates a tag entry for a given resource, waiting for the latter
+        to be visible if needed
 
         :param rid: Resource id
         :k: Tag key, will be titled (upper case first letter)
         :v: Tag value
         '''
-        self.resource.create_tags(
-            Resources = [rid],
-            Tags = self.mktags({
+        waiter(self.resource.create_tags, kwargs = {
+            'Resources': [rid],
+            'Tags': self.mktags({
                 k.title(): v
             })
-        )
+        })
 
     def lsinstnames(self):
         '''Returns a dict of instances ids and Name tag
@@ -147,6 +823,36 @@ class Aws:
 
         return instname
 
+    def findinstances(self, name):
+        '''Returns instances matching an ``id`` or a Name tag, resolved by a
+        server-side filter
+
+        :param str name: Instance ``id`` or Name tag, a Name without wildcard
+                         matches any Name containing it
+
+        :return: ``iterinstances`` records
+        :rtype: list
+        '''
+        if name.startswith('i-'):
+            f = {'Name': 'instance-id', 'Values': [name]}
+        else:
+            if not '*' in name and not '?' in name:
+                name = '*{0}*'.format(name)
+            f = {'Name': 'tag:Name', 'Values': [name]}
+        return list(self.iterinstances([f]))
+
+    def console(self, iid):
+        '''Returns console output of an instance
+
+        :param str iid: Instance ``id``
+
+        :return: Console output, empty if there is none yet
+        :rtype: str
+        '''
+        return self.client.get_console_output(
+            InstanceId = iid
+        ).get('Output') or ''
+
     def dmesg(self, name):
         '''Returns console output for a given instance ``id`` or Name tag
 
@@ -155,10 +861,33 @@ class Aws:
         :return: Console output
         :rtype: str
         '''
-        instances = self.lsinstnames()
-        for i in instances:
-            if name in i or name in instances[i]:
-                return self.client.get_console_output(InstanceId=i)['Output']
+        for i in self.findinstances(name):
+            return self.console(i['id'])
+
+    def dmesgs(self, instances, jobs = 8):
+        '''Fetches console output of many instances concurrently
+
+        :param list instances: ``iterinstances`` records
+        :param int jobs: Number of concurrent requests
+
+        :return: ``(instance, output)`` tuples, as soon as they are fetched
+        :rtype: generator
+        '''
+        def _fetch(i):
+            try:
+                return i, self.console(i['id'])
+            except ClientError as e:
+                return i, 'error: {0}\n'.format(e)
+
+        if not instances:
+            return
+        pool = ThreadPool(max(1, min(jobs, len(instances))))
+        try:
+            for ret in pool.imap_unordered(_fetch, instances):
+                yield ret
+        finally:
+            pool.close()
+            pool.join()
 
     def getamis(self, glob):
         '''Returns all AMI ids and creation date ordered by the latter
@@ -168,12 +897,23 @@ class Aws:
         :return: Ordered list of AMI ids
         :rtype: list
         '''
-        imgs = {}
-        for i in self.resource.images.filter(
-            Filters = [{'Name': 'name', 'Values': [glob]}]
-        ):
-            imgs[i.id] = i.creation_date
-        return sorted(imgs, key = imgs.get)
+        key = '{0}|{1}'.format(self.region, glob)
+        # resolve each glob once, even with many workers asking for it
+        with _amilock(key):
+            amis = amicache.get(key)
+            if amis is None:
+                imgs = self.client.describe_images(
+                    Filters = [{'Name': 'name', 'Values': [glob]}]
+                )['Images']
+                amis = sorted(
+                    [[i['ImageId'], i['CreationDate']] for i in imgs],
+                    key = lambda i: i[1]
+                )
+                # the AMI may be published any time, look for it again
+                if amis:
+                    amicache.set(key, amis)
+
+        return [i[0] for i in amis]
 
     def get_debian_ami(self, glob):
         '''Returns an AMI id matching with official debian wiki list
@@ -181,17 +921,24 @@ class Aws:
         :return: Latest AMI matching the ``glob``
         :rtype: str
         '''
-        for rel in ['Wheezy', 'Jessie']:
-            if rel.lower() in glob:
-                break
-
-        r = requests.get(
-            'https://wiki.debian.org/Cloud/AmazonEC2Image/{0}'.format(rel)
-        )
-        for ami in self.getamis(glob):
-            if ami in r.text:
+        key = 'debian|{0}|{1}'.format(self.region, glob)
+        with _amilock(key):
+            ami = amicache.get(key)
+            if ami is not None:
                 return ami
 
+            for rel in ['Wheezy', 'Jessie']:
+                if rel.lower() in glob:
+                    break
+
+            r = requests.get(
+                'https://wiki.debian.org/Cloud/AmazonEC2Image/{0}'.format(rel)
+            )
+            for ami in self.getamis(glob):
+                if ami in r.text:
+                    amicache.set(key, ami)
+                    return ami
+
     def getami(self, glob):
         '''Returns the latest AMI matching ``glob``
 
@@ -199,8 +946,12 @@ class Aws:
 
         :return: Latest AMI matching the ``glob``
         :rtype: str
+        :raises ValueError: When no AMI matches
         '''
-        return self.getamis(glob)[-1]
+        amis = self.getamis(glob)
+        if not amis:
+            raise ValueError('no AMI matching {0}'.format(glob))
+        return amis[-1]
 
     def getinst(self, iid):
         '''Returns an instance resource
@@ -221,6 +972,47 @@ class Aws:
         '''
         return [i for i in getattr(self.resource, res).all()]
 
+    def iterpages(self, filters = None, pagesize = 1000):
+        '''Yields lightweight instance records, one page at a time
+
+        Unlike ``getall``, no instance resource is built and only one page of
+        ``describe_instances`` is held in memory at a time.
+
+        :param list filters: Server-side ``Filters``, as in
+                             ``describe_instances``
+        :param int pagesize: Number of instances per page
+
+        :return: Lists of dicts with ``id``, ``type``, ``state``, ``az`` and
+                 ``tags``
+        :rtype: generator
+        '''
+        pages = self.client.get_paginator('describe_instances').paginate(
+            Filters = filters or [],
+            PaginationConfig = {'PageSize': pagesize}
+        )
+        for page in pages:
+            yield [{
+                'id': i['InstanceId'],
+                'type': i['InstanceType'],
+                'state': i['State']['Name'],
+                'az': i['Placement']['AvailabilityZone'],
+                'tags': self.tags2dict(i['Tags']) if 'Tags' in i else None
+            } for r in page['Reservations'] for i in r['Instances']]
+
+    def iterinstances(self, filters = None, pagesize = 1000):
+        '''Yields a lightweight record for every instance, see ``iterpages``
+
+        :param list filters: Server-side ``Filters``, as in
+                             ``describe_instances``
+        :param int pagesize: Number of instances per page
+
+        :return: Dicts with ``id``, ``type``, ``state``, ``az`` and ``tags``
+        :rtype: generator
+        '''
+        for page in self.iterpages(filters, pagesize):
+            for i in page:
+                yield i
+
     def change_nsrecord(self, action, dnsrecord):
         '''Create, delete or modify a DNS record
 
@@ -252,19 +1044,56 @@ class Aws:
 
            obj.change_nsrecord('CREATE', dnsrecord)
 
+        To change many records, ``DnsBatch`` groups them per zone.
+
         Documentation:
 
         * http://docs.aws.amazon.com/Route53/latest/APIReference/CreateAliasRRSAPI.html
         * http://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/quickref-route53.html
         * http://docs.aws.amazon.com/Route53/latest/DeveloperGuide/resource-record-sets-choosing-alias-non-alias.html
 
+        :return: Change id
+        :rtype: str
         '''
 
-        hzones = self.client.list_hosted_zones_by_name(
-            DNSName = dnsrecord['zone']
+        change = self.mkchange(action, dnsrecord)
+
+        return self.submit_changes(
+            self.zoneid(dnsrecord['zone']), [change], '{0} / {1} / {2}'.format(
+                action, dnsrecord['name'], dnsrecord['zone']
+            )
         )
-        zoneid = hzones['HostedZones'][0]['Id']
 
+    def zoneid(self, zone):
+        '''Returns a hosted zone id, looked up once per run
+
+        :param str zone: Domain name, like ``foo.com``
+
+        :return: Hosted zone id
+        :rtype: str
+        :raises ValueError: When there is no such hosted zone
+        '''
+        with self._lock:
+            if not zone in self._zones:
+                hzones = waiter(
+                    self.client.list_hosted_zones_by_name,
+                    kwargs = {'DNSName': zone, 'MaxItems': '1'},
+                    retry = throttled
+                )['HostedZones']
+                if not hzones or \
+                    hzones[0]['Name'].rstrip('.') != zone.rstrip('.'):
+                    raise ValueError('no hosted zone {0}'.format(zone))
+                self._zones[zone] = hzones[0]['Id']
+            return self._zones[zone]
+
+    def mkchange(self, action, dnsrecord):
+        '''Makes a ``ChangeBatch`` item from a DNS record
+
+        :param str action: One of ``CREATE``, ``DELETE`` or ``UPSERT``
+        :param dict dnsrecord: DNS record, as in ``change_nsrecord``
+
+        :rtype: dict
+        '''
         dnsname = '{0}.{1}.'.format(dnsrecord['name'], dnsrecord['zone'])
 
         change = {
@@ -295,14 +1124,36 @@ class Aws:
                 {'Value': dnsrecord['target']}
             ]
 
-        cb = {
-            'Comment': '{0} / {1} / {2}'.format(
-                action, dnsrecord['name'], dnsrecord['zone']
-            ),
-            'Changes': [change]
-        }
+        return change
 
-        self.client.change_resource_record_sets(
-            HostedZoneId = zoneid,
-            ChangeBatch = cb
-        )
+    def submit_changes(self, zoneid, changes, comment = ''):
+        '''Submits a ``ChangeBatch``, retrying while throttled
+
+        :param str zoneid: Hosted zone id
+        :param list changes: ``Changes`` items
+        :param str comment: Batch comment
+
+        :return: Change id
+        :rtype: str
+        '''
+        return waiter(self.client.change_resource_record_sets, kwargs = {
+            'HostedZoneId': zoneid,
+            'ChangeBatch': {'Comment': comment, 'Changes': changes}
+        }, retry = throttled, timeout = 120)['ChangeInfo']['Id']
+
+    def wait_changes(self, ids, timeout = 300):
+        '''Waits for route53 changes to be propagated
+
+        :param list ids: Change ids
+        :param int timeout: Give up after that many seconds
+
+        :raises WaiterTimeout: When ``timeout`` is reached
+        '''
+        deadline = time.time() + timeout
+        for cid in ids:
+            waiter(
+                self.client.get_change, kwargs = {'Id': cid},
+                until = lambda r: r['ChangeInfo']['Status'] == 'INSYNC',
+                retry = throttled, base = 2, cap = 15,
+                timeout = max(1, deadline - time.time())
+            )
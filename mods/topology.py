@@ -0,0 +1,245 @@
+'''Region network topology snapshot
+
+.. module:: Topology
+   :platform: UNIX
+   :synopsis: Answer network existence checks without an API call each
+
+Availability zones, subnets, route tables with their associations and
+routes, internet and VPN gateways are loaded once per region with a handful
+of bulk ``describe`` calls. NAT instances are looked up by Name, all at once
+when their names are known in advance. Every check is then answered from the
+snapshot, which is updated in place as resources are created, so it stays
+valid for the whole run.
+
+Typical usage:
+
+   .. code-block:: python
+
+      topo = Topology(Aws('ireland', 'ec2'))
+      if topo.subnet('foo-net-aza') is None:
+          topo.add_subnet(ec2.client.create_subnet(
+              VpcId = vpcid, CidrBlock = '10.1.1.0/24',
+              AvailabilityZone = topo.az('a')
+          )['Subnet'])
+'''
+
+import threading
+
+
+def _pages(client, call, **kwargs):
+    if client.can_paginate(call):
+        return client.get_paginator(call).paginate(**kwargs)
+    return [getattr(client, call)(**kwargs)]
+
+
+class Topology(object):
+    '''Topology class constructor, nothing is loaded until first needed
+
+    :param aws: ``Aws`` EC2 object of the region
+    '''
+    def __init__(self, aws):
+        self.aws = aws
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.azs = {}
+        self.subnets = {}
+        self.route_tables = {}
+        self.igws = {}
+        self.vgws = {}
+        self.nats = {}
+
+    def load(self):
+        '''Loads the snapshot, with one describe call per resource type
+        '''
+        with self.lock:
+            if self.loaded:
+                return
+            client = self.aws.client
+
+            for az in client.describe_availability_zones()['AvailabilityZones']:
+                # us-east-1[a] == az[a]
+                self.azs[az['ZoneName'][-1]] = az['ZoneName']
+
+            subnets = [
+                s for p in _pages(client, 'describe_subnets')
+                for s in p['Subnets']
+            ]
+            for s in subnets:
+                self.add_subnet(s)
+            self.aws.index_nametags('subnets', subnets)
+
+            rts = [
+                r for p in _pages(client, 'describe_route_tables')
+                for r in p['RouteTables']
+            ]
+            for r in rts:
+                self.add_route_table(r)
+            self.aws.index_nametags('route_tables', rts)
+
+            for p in _pages(client, 'describe_internet_gateways'):
+                for g in p['InternetGateways']:
+                    self.igws[g['InternetGatewayId']] = [
+                        a['VpcId'] for a in g.get('Attachments', [])
+                    ]
+
+            for g in client.describe_vpn_gateways()['VpnGateways']:
+                self.vgws[g['VpnGatewayId']] = [
+                    a['VpcId'] for a in g.get('VpcAttachments', [])
+                    if a.get('State') == 'attached'
+                ]
+
+            self.loaded = True
+
+    def load_nats(self, names):
+        '''Looks up many NAT instances by Name with a single describe call
+
+        :param list names: NAT instances Name tags
+        '''
+        with self.lock:
+            names = sorted(set(names) - set(self.nats))
+            if not names:
+                return
+            for name in names:
+                self.nats[name] = None
+            pages = _pages(
+                self.aws.client, 'describe_instances',
+                Filters = [{'Name': 'tag:Name', 'Values': names}]
+            )
+            for p in pages:
+                for r in p['Reservations']:
+                    for i in r['Instances']:
+                        name = self.aws.tags2dict(i.get('Tags', [])).get('Name')
+                        if self.nats.get(name) is None:
+                            self.nats[name] = i['InstanceId']
+
+    def _name(self, o):
+        return self.aws.tags2dict(o.get('Tags', [])).get('Name')
+
+    def add_subnet(self, s):
+        '''Records a subnet
+
+        :param dict s: Subnet, as described by the API
+        '''
+        with self.lock:
+            self.subnets[s['SubnetId']] = {
+                'name': self._name(s),
+                'cidr': s['CidrBlock'],
+                'az': s['AvailabilityZone'],
+                'vpc': s['VpcId'],
+            }
+
+    def add_route_table(self, r):
+        '''Records a route table
+
+        :param dict r: Route table, as described by the API
+        '''
+        with self.lock:
+            self.route_tables[r['RouteTableId']] = {
+                'name': self._name(r),
+                'vpc': r['VpcId'],
+                'subnets': set(
+                    a['SubnetId'] for a in r.get('Associations', [])
+                    if a.get('SubnetId')
+                ),
+                'routes': set(
+                    x['DestinationCidrBlock'] for x in r.get('Routes', [])
+                    if 'DestinationCidrBlock' in x
+                ),
+                'vgws': set(
+                    v['GatewayId'] for v in r.get('PropagatingVgws', [])
+                ),
+            }
+
+    def _find(self, objs, name, vpcid = None):
+        self.load()
+        with self.lock:
+            for oid in sorted(objs):
+                o = objs[oid]
+                if o['name'] == name and vpcid in (None, o['vpc']):
+                    return oid
+        return None
+
+    def az(self, letter):
+        '''Returns the full name of an AZ
+
+        :param str letter: AZ letter, like ``a``
+
+        :return: AZ name or ``None``
+        '''
+        self.load()
+        return self.azs.get(letter)
+
+    def subnet(self, name, vpcid = None):
+        '''Returns a subnet id by Name tag, or ``None``
+        '''
+        return self._find(self.subnets, name, vpcid)
+
+    def cidr_owner(self, cidr, vpcid):
+        '''Returns the id of a VPC subnet using a CIDR, or ``None``
+        '''
+        self.load()
+        with self.lock:
+            for sid in sorted(self.subnets):
+                s = self.subnets[sid]
+                if s['vpc'] == vpcid and s['cidr'] == cidr:
+                    return sid
+        return None
+
+    def route_table(self, name, vpcid = None):
+        '''Returns a route table id by Name tag, or ``None``
+        '''
+        return self._find(self.route_tables, name, vpcid)
+
+    def igw(self, vpcid):
+        '''Returns the internet gateway attached to a VPC, or ``None``
+        '''
+        self.load()
+        for gid in sorted(self.igws):
+            if vpcid in self.igws[gid]:
+                return gid
+        return None
+
+    def vgw(self, vpcid):
+        '''Returns the VPN gateway attached to a VPC, or ``None``
+        '''
+        self.load()
+        for gid in sorted(self.vgws):
+            if vpcid in self.vgws[gid]:
+                return gid
+        return None
+
+    def nat(self, name):
+        '''Returns a NAT instance id by Name tag, or ``None``
+        '''
+        self.load_nats([name])
+        return self.nats[name]
+
+    def associate(self, rtid, subnetid):
+        '''Records a route table association
+        '''
+        with self.lock:
+            self.route_tables[rtid]['subnets'].add(subnetid)
+
+    def has_route(self, rtid, cidr):
+        '''Tells if a route table has a route to a destination
+        '''
+        with self.lock:
+            return cidr in self.route_tables[rtid]['routes']
+
+    def add_route(self, rtid, cidr):
+        '''Records a route
+        '''
+        with self.lock:
+            self.route_tables[rtid]['routes'].add(cidr)
+
+    def propagates(self, rtid, vgwid):
+        '''Tells if a route table propagates routes from a VPN gateway
+        '''
+        with self.lock:
+            return vgwid in self.route_tables[rtid]['vgws']
+
+    def add_propagation(self, rtid, vgwid):
+        '''Records a VPN gateway route propagation
+        '''
+        with self.lock:
+            self.route_tables[rtid]['vgws'].add(vgwid)
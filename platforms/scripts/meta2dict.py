@@ -9,47 +9,435 @@ Its usage is trivial::
     import meta2dict
 
     ec2meta = meta2dict.load()
+    ec2meta['meta-data']['instance-id']
+
+Metadata are fetched lazily, a directory is only listed when one of its keys
+is first accessed, so the example above only makes two requests. Use
+``ec2meta.to_dict()`` or ``meta2dict.load(lazy=False)`` to get the whole
+tree as a plain dict.
+
+Fetched values are shared between processes through a snapshot file (see
+``SNAPSHOT``), each key being reused as long as its TTL allows (see
+``TTLS``). Only one process at a time refreshes the snapshot, others wait
+for it and read the refreshed values instead of querying the metadata
+service themselves.
 
 .. _virtual web server:
    http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ec2-instance-metadata.html
 
 """
 
+import os
 import json
+import time
+import fcntl
+import tempfile
+import threading
 import requests
+from multiprocessing.pool import ThreadPool
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+#: metadata service address
+METAHOST = 'http://169.254.169.254'
+#: IMDSv2 session token lifetime, in seconds
+TOKEN_TTL = 21600
+#: maximum number of concurrent requests
+WORKERS = 8
+#: snapshot file shared by processes of the same user, ``None`` disables it;
+#: it must live in a directory only its owner can write to
+SNAPSHOT = os.environ.get(
+    'META2DICT_SNAPSHOT',
+    os.path.join(
+        os.environ.get('XDG_RUNTIME_DIR') or os.path.join(
+            tempfile.gettempdir(), 'meta2dict-{0}'.format(os.getuid())
+        ),
+        'meta2dict.json'
+    )
+)
+#: snapshot TTLs in seconds by path prefix, longest prefix wins, ``None``
+#: means forever and 0 never caches (i.e. credentials)
+TTLS = [
+    ('', 300),
+    ('latest/meta-data/ami-id', None),
+    ('latest/meta-data/instance-id', None),
+    ('latest/meta-data/instance-type', None),
+    ('latest/meta-data/placement/', None),
+    ('latest/dynamic/instance-identity/', None),
+    ('latest/meta-data/events/', 30),
+    ('latest/meta-data/spot/', 5),
+    ('latest/meta-data/iam/security-credentials/', 0),
+    ('latest/meta-data/identity-credentials/', 0),
+]
+#: only those response status are kept in the snapshot, errors like
+#: throttling are returned but never shared with other processes
+SNAPSHOT_STATUS = (200, 404)
+
+
+def session():
+    """Returns a ``requests`` session ready to query the metadata service.
+
+    An IMDSv2 session token is requested first and sent along with every
+    request made through the returned session. If the service does not
+    hand one out, plain IMDSv1 requests are made.
+
+    Return:
+        requests.Session: metadata service session.
+
+    """
+    s = requests.Session()
+    try:
+        r = s.put(
+            '{0}/latest/api/token'.format(METAHOST),
+            headers={'X-aws-ec2-metadata-token-ttl-seconds': str(TOKEN_TTL)},
+            timeout=2
+        )
+        if r.status_code == 200:
+            s.headers['X-aws-ec2-metadata-token'] = r.text
+    except requests.exceptions.RequestException:
+        pass
+
+    return s
+
+
+def _private(st, mask=0o077):
+    """Tells if a file or directory belongs to us and is out of reach of
+    other users.
+
+    Args:
+        st (os.stat_result): file status.
+        mask (int): permission bits other users must not have.
+
+    Return:
+        bool: whether it can be trusted.
+
+    """
+    return st.st_uid == os.getuid() and not st.st_mode & mask
+
+
+def _private_dir(path):
+    """Creates the snapshot directory if needed and checks nobody else can
+    add, remove or replace files in it.
+
+    Args:
+        path (str): snapshot file.
+
+    Return:
+        bool: whether the snapshot directory can be used.
+
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    try:
+        os.mkdir(dirname, 0o700)
+    except OSError:
+        pass
+    try:
+        return _private(os.lstat(dirname), 0o022)
+    except OSError:
+        return False
+
+
+def _ttl(key):
+    """Returns the snapshot TTL of a metadata path.
+
+    Args:
+        key (str): path, relative to ``METAHOST``.
+
+    Return:
+        int: TTL in seconds, ``None`` for forever.
+
+    """
+    best = ('', 300)
+    for prefix, ttl in TTLS:
+        if key.startswith(prefix) and len(prefix) >= len(best[0]):
+            best = (prefix, ttl)
+    return best[1]
+
+
+class _Response(object):
+    """Response read from the snapshot.
+
+    Args:
+        status_code (int): HTTP status code.
+        text (str): response body.
+
+    """
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+
+class Snapshot(object):
+    """Metadata fetcher backed by a snapshot file shared between processes.
+
+    Fresh snapshot entries are served without any request nor lock. Missing
+    or expired ones are fetched while holding an exclusive lock on
+    ``<path>.lock``, after reading the snapshot again in case another
+    process just refreshed it, then the snapshot is atomically replaced.
+
+    The snapshot directory and files must belong to the current user and be
+    private to them, otherwise, or when they cannot be used at all, metadata
+    are fetched directly from the service.
+
+    Args:
+        path (str): snapshot file, ``None`` to query the service directly.
+
+    """
+    def __init__(self, path=SNAPSHOT):
+        self.path = path if path is None or _private_dir(path) else None
+        self._session = None
+        self._lock = threading.Lock()
+        self._data = self._read()
+
+    def _http(self):
+        # no token is requested until we really need to query the service
+        with self._lock:
+            if self._session is None:
+                self._session = session()
+            return self._session
+
+    def _open(self, path, flags):
+        # never follow links nor trust files someone else could have written
+        fd = os.open(path, flags | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        if not _private(os.fstat(fd)):
+            os.close(fd)
+            raise OSError('{0} is not private, ignoring it'.format(path))
+        return fd
+
+    def _read(self):
+        if self.path is None:
+            return {}
+        try:
+            with os.fdopen(self._open(self.path, os.O_RDONLY), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self):
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(prefix='.meta2dict', dir=dirname)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._data, f)
+            os.rename(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def _fetch(self, urls, pool):
+        http = self._http()
+        if pool is not None:
+            return pool.map(http.get, urls)
+        return [http.get(u) for u in urls]
+
+    def _fresh(self, key, now):
+        e = self._data.get(key)
+        if e is None:
+            return None
+        ttl = _ttl(key)
+        if ttl is not None and now - e[0] >= ttl:
+            return None
+        return _Response(e[1], e[2])
+
+    def get(self, url):
+        """Fetches a single metadata URL.
+
+        Args:
+            url (str): URL to fetch.
+
+        Return:
+            requests.Response or _Response: response.
 
+        """
+        return self.get_many([url])[0]
 
-def load(root='latest'):
+    def get_many(self, urls, pool=None):
+        """Fetches many metadata URLs, concurrently if a pool is given.
+
+        Args:
+            urls (list): URLs to fetch.
+            pool (ThreadPool): pool to fetch missing URLs with.
+
+        Return:
+            list: responses, in ``urls`` order.
+
+        """
+        if self.path is None:
+            return self._fetch(urls, pool)
+
+        keys = [u[len(METAHOST) + 1:] for u in urls]
+        rs = [self._fresh(k, time.time()) for k in keys]
+        if all(r is not None for r in rs):
+            return rs
+
+        try:
+            lock = os.fdopen(self._open(
+                '{0}.lock'.format(self.path), os.O_WRONLY | os.O_CREAT
+            ), 'w')
+        except (IOError, OSError):
+            # no usable snapshot, query the service
+            return self._fetch(urls, pool)
+
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # someone may have refreshed it while we were waiting
+                self._data = self._read()
+                now = time.time()
+                rs = [self._fresh(k, now) for k in keys]
+                missing = [i for i, r in enumerate(rs) if r is None]
+                fetched = self._fetch([urls[i] for i in missing], pool)
+                # entries with a null TTL, like credentials, and errors are
+                # not kept
+                changed = False
+                for i, r in zip(missing, fetched):
+                    rs[i] = r
+                    if _ttl(keys[i]) != 0 and \
+                        r.status_code in SNAPSHOT_STATUS:
+                        self._data[keys[i]] = [now, r.status_code, r.text]
+                        changed = True
+                if changed:
+                    try:
+                        self._write()
+                    except (IOError, OSError):
+                        pass
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        return rs
+
+
+class LazyMetadata(Mapping):
+    """Read-only mapping over a metadata directory, fetched on access.
+
+    The directory is listed when a key is first looked up, and values are
+    fetched and memoized when first accessed. Subdirectories are
+    ``LazyMetadata`` themselves.
+
+    Args:
+        http (Snapshot): fetcher to query the metadata service with
+        url (str): directory URL, with a final '/'
+        listing (dict): known directory content, as returned by ``_list``,
+            to avoid listing it
+
+    """
+    def __init__(self, http, url, listing=None):
+        self._http = http
+        self._url = url
+        self._listing = listing
+        self._values = {}
+
+    def _list(self):
+        """Returns the directory content, listing it on first call.
+
+        Return:
+            dict: key to (URL, is a directory) tuples.
+
+        """
+        if self._listing is None:
+            self._listing = _parse_listing(self._url, self._http.get(self._url))
+        return self._listing
+
+    def __getitem__(self, key):
+        url, isdir = self._list()[key]
+        if key not in self._values:
+            if isdir:
+                self._values[key] = LazyMetadata(self._http, url)
+            else:
+                self._values[key] = _leaf(self._http.get(url))
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._list())
+
+    def __len__(self):
+        return len(self._list())
+
+    def __repr__(self):
+        return 'LazyMetadata({0})'.format(self._url)
+
+    def to_dict(self, workers=WORKERS):
+        """Returns the whole directory as a plain dict.
+
+        Already fetched values are reused, everything else is crawled
+        concurrently.
+
+        Args:
+            workers (int): maximum number of concurrent requests.
+
+        Return:
+            dict: directory metadata.
+
+        """
+        dirs = []
+        leaves = []
+        d = self._materialize(dirs, leaves)
+        _datacrawl(self._http, dirs, workers, leaves)
+        return d
+
+    def _materialize(self, dirs, leaves):
+        if self._listing is None:
+            d = {}
+            dirs.append((self._url, d))
+            return d
+
+        d = {}
+        for key, (url, isdir) in self._listing.items():
+            if key in self._values:
+                v = self._values[key]
+                d[key] = v._materialize(dirs, leaves) if isdir else v
+            elif isdir:
+                d[key] = {}
+                dirs.append((url, d[key]))
+            else:
+                leaves.append((url, d, key))
+        return d
+
+
+def load(root='latest', workers=WORKERS, lazy=True, snapshot=SNAPSHOT):
     """Returns instance metadata in a dict format.
 
     Args:
         root (str): root directory.
+        workers (int): maximum number of concurrent requests.
+        lazy (bool): return a ``LazyMetadata`` rather than crawling the
+            whole tree.
+        snapshot (str): snapshot file, ``None`` to query the service
+            directly.
 
     Return:
-        dict: instance metadata.
+        LazyMetadata or dict: instance metadata.
 
     """
-    metaurl = 'http://169.254.169.254/{0}'.format(root)
+    metaurl = '{0}/{1}'.format(METAHOST, root)
     # those 3 top subdirectories are not exposed with a final '/'
-    metadict = {'dynamic': {}, 'meta-data': {}, 'user-data': {}}
+    metadata = LazyMetadata(Snapshot(snapshot), '{0}/'.format(metaurl), dict(
+        (subsect, ('{0}/{1}/'.format(metaurl, subsect), True))
+        for subsect in ['dynamic', 'meta-data', 'user-data']
+    ))
 
-    for subsect in metadict:
-        _datacrawl('{0}/{1}/'.format(metaurl, subsect), metadict[subsect])
+    if lazy:
+        return metadata
+    return metadata.to_dict(workers)
 
-    return metadict
 
-
-def _datacrawl(url, d):
-    """Recursively populates a dict with metadata.
+def _parse_listing(url, r):
+    """Parses a directory listing.
 
     Args:
-        url (str): URL to parse
-        d (dict): dict to populate data with
+        url (str): directory URL
+        r (requests.Response): directory listing response
+
+    Return:
+        dict: key to (URL, is a directory) tuples.
 
     """
-    r = requests.get(url)
+    listing = {}
     if r.status_code == 404:
-        return
+        return listing
 
     for l in r.text.split('\n'):
         if not l: # handle "instance-identity/\n" case
@@ -57,22 +445,75 @@ def _datacrawl(url, d):
         newurl = '{0}{1}'.format(url, l)
         # a key is detected with a final '/'
         if l.endswith('/'):
-            newkey = l.split('/')[-2]
-            d[newkey] = {}
-            _datacrawl(newurl, d[newkey])
-
+            listing[l.split('/')[-2]] = (newurl, True)
         else:
-            r = requests.get(newurl)
-            if r.status_code != 404:
-                try:
-                    d[l] = json.loads(r.text)
-                except ValueError:
-                    d[l] = r.text
-            else:
-                d[l] = None
+            listing[l] = (newurl, False)
+
+    return listing
+
+
+def _leaf(r):
+    """Converts a leaf response to its value.
+
+    Args:
+        r (requests.Response): leaf response.
+
+    Return:
+        leaf value, decoded from ``JSON`` when possible.
+
+    """
+    if r.status_code == 404:
+        return None
+    try:
+        return json.loads(r.text)
+    except ValueError:
+        return r.text
+
+
+def _datacrawl(http, dirs, workers=WORKERS, leaves=None):
+    """Populates dicts with metadata, level by level.
+
+    Every directory listing and leaf known at a given depth is fetched
+    concurrently, reusing ``http`` connections.
+
+    Args:
+        http (Snapshot): fetcher to query the metadata service with
+        dirs (list): (URL to parse, dict to populate data with) tuples
+        workers (int): maximum number of concurrent requests
+        leaves (list): (URL, dict to populate, key) tuples of known leaves
+
+    """
+    leaves = leaves or []
+    if not dirs and not leaves:
+        return
+
+    pool = ThreadPool(workers)
+    try:
+        while dirs or leaves:
+            urls = [u for u, _ in dirs] + [u for u, _, _ in leaves]
+            rs = http.get_many(urls, pool)
+            listings, rs = rs[:len(dirs)], rs[len(dirs):]
+
+            for (url, d, l), r in zip(leaves, rs):
+                d[l] = _leaf(r)
+
+            leaves = []
+            newdirs = []
+            for (url, d), r in zip(dirs, listings):
+                listing = _parse_listing(url, r)
+                for key, (newurl, isdir) in listing.items():
+                    if isdir:
+                        d[key] = {}
+                        newdirs.append((newurl, d[key]))
+                    else:
+                        leaves.append((newurl, d, key))
+            dirs = newdirs
+    finally:
+        pool.close()
+        pool.join()
 
 
 
 if __name__ == '__main__':
     # test the load function
-    print(json.dumps(load()))
+    print(json.dumps(load(lazy=False)))
@@ -0,0 +1,134 @@
+'''Shared test helpers: a recording ``boto3`` stand-in and ``ec2.py`` loader
+'''
+
+import os
+import imp
+import sys
+import types
+import threading
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+# every boto3 call made by the code under test
+calls = []
+# API replies by (service, operation), called with the profile and arguments
+replies = {}
+# region of each profile, eu-west-1 by default
+regions = {}
+
+
+class FakePaginator(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def paginate(self, **kwargs):
+        kwargs.pop('PaginationConfig', None)
+        reply = getattr(self.client, self.name)(**kwargs)
+        # a list of replies stands for several pages
+        for page in reply if isinstance(reply, list) else [reply]:
+            yield page
+
+
+class FakeClient(object):
+    def __init__(self, profile, service):
+        self.profile = profile
+        self.service = service
+
+    def get_paginator(self, name):
+        return FakePaginator(self, name)
+
+    def can_paginate(self, name):
+        return True
+
+    def __getattr__(self, name):
+        def _call(*args, **kwargs):
+            calls.append(('call', self.profile, self.service, name))
+            if (self.service, name) not in replies:
+                raise AssertionError('unexpected AWS call {0}'.format(name))
+            return replies[(self.service, name)](self.profile, **kwargs)
+        return _call
+
+
+class FakeSession(object):
+    available_profiles = ['default']
+
+    def __init__(self, profile_name = None):
+        calls.append(('session', profile_name))
+        self.profile_name = profile_name
+        self._session = self
+
+    def get_config_variable(self, name):
+        return regions.get(self.profile_name, 'eu-west-1')
+
+    def client(self, service, *args, **kwargs):
+        calls.append(('client', self.profile_name, service))
+        return FakeClient(self.profile_name, service)
+
+    def resource(self, service, *args, **kwargs):
+        calls.append(('resource', self.profile_name, service))
+        return FakeClient(self.profile_name, service)
+
+
+class ClientError(Exception):
+    def __init__(self, response, operation_name = ''):
+        Exception.__init__(self, response)
+        self.response = response
+
+
+class ResourceNotExistsError(Exception):
+    pass
+
+
+boto3 = types.ModuleType('boto3')
+boto3.Session = FakeSession
+boto3.exceptions = types.ModuleType('boto3.exceptions')
+boto3.exceptions.ResourceNotExistsError = ResourceNotExistsError
+botocore = types.ModuleType('botocore')
+botocore.exceptions = types.ModuleType('botocore.exceptions')
+botocore.exceptions.ClientError = ClientError
+sys.modules['boto3'] = boto3
+sys.modules['boto3.exceptions'] = boto3.exceptions
+sys.modules['botocore'] = botocore
+sys.modules['botocore.exceptions'] = botocore.exceptions
+
+
+@pytest.fixture(autouse = True)
+def cachehome(monkeypatch, tmpdir):
+    '''Keeps awstools caches out of the real HOME
+    '''
+    path = tmpdir.join('cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(path))
+    return path
+
+
+@pytest.fixture
+def aws_calls(monkeypatch):
+    '''Records boto3 activity, starting from an empty session registry
+    '''
+    import mods.session
+    mods.session._sessions.clear()
+    mods.session._clients.clear()
+    monkeypatch.setattr(mods.session, '_resources', threading.local())
+    del calls[:]
+    replies.clear()
+    regions.clear()
+    return calls
+
+
+@pytest.fixture
+def load_ec2(monkeypatch, aws_calls):
+    '''Returns a function importing a fresh ``ec2.py`` for a command line
+    '''
+    if sys.version_info[0] > 2:
+        pytest.skip('ec2.py is a Python 2 script')
+
+    def _load(*argv):
+        monkeypatch.setenv('EC2REGION', 'ireland')
+        monkeypatch.setattr(sys, 'argv', ['ec2.py'] + list(argv))
+        monkeypatch.chdir(root)
+        return imp.load_source('ec2', os.path.join(root, 'ec2.py'))
+    return _load
@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import time
+
+import pytest
+
+pytest.importorskip('bs4')
+
+import mods.awsprice as ap
+from mods.cache import DiskCache
+
+
+@pytest.fixture
+def catalog(monkeypatch, tmpdir):
+    def _catalog():
+        c = DiskCache(
+            'prices', ttl = 3600, path = str(tmpdir.join('prices')),
+            sharded = True
+        )
+        monkeypatch.setattr(ap, 'catalog', c)
+        return c
+    return _catalog
+
+
+def _region(name):
+    return {
+        'region': name,
+        'instanceTypes': [{'type': 't{0}'.format(i)} for i in range(2000)],
+    }
+
+
+def test_lookup_reads_one_region(catalog, monkeypatch):
+    regions = ['region-{0}'.format(i) for i in range(20)]
+    catalog().setmany(dict(
+        (ap._catalog_key('ec2', 'linux-od', r), _region(r)) for r in regions
+    ))
+
+    # a fresh run, nothing is downloaded and only one region is read
+    c = catalog()
+    monkeypatch.setattr(ap, 'get_model', None)
+    found = ap.get_all_instances('region-7', 'ec2', 'linux-od')
+
+    assert found['region'] == 'region-7'
+    assert list(c.data) == [ap._catalog_key('ec2', 'linux-od', 'region-7')]
+
+
+def test_regions_instances_parse_once(catalog, monkeypatch):
+    catalog()
+    models = []
+
+    def _get_model(resource, restype):
+        models.append(restype)
+        return 'callback({"config":{"regions":[' + ','.join(
+            '{"region":"r%d","instanceTypes":[]}' % i for i in range(3)
+        ) + ']}})'
+
+    monkeypatch.setattr(ap, 'get_model', _get_model)
+    found = ap.get_regions_instances(['r0', 'r2', 'nope'], 'ec2', 'linux-od')
+
+    assert sorted(found) == ['r0', 'r2']
+    assert models == ['linux-od']
+    assert sorted(ap.get_regions_instances(['r0', 'r1'], 'ec2', 'linux-od')) \
+        == ['r0', 'r1']
+    assert models == ['linux-od']
+
+
+def _pricelist(ntypes):
+    def _term(name, i):
+        options = [
+            ('allUpfront', 'full'), ('partialUpfront', 'partial'),
+            ('noUpfront', 'noup'),
+        ]
+        return {
+            'term': name,
+            'onDemandHourly': [{'prices': {'USD': str(i)}}],
+            'purchaseOptions': [{
+                'purchaseOption': opt,
+                'valueColumns': [{
+                    'name': col,
+                    'prices': {'USD': '{0}.{1}.{2}.{3}'.format(name, i, o, col)},
+                } for col in ('upfront', 'monthlyStar', 'effectiveHourly')],
+            } for opt, o in options],
+        }
+
+    return {'instanceTypes': [{
+        'type': 'x{0}.large'.format(i),
+        'sizes': [{'size': 'x{0}.large'.format(i), 'vCPU': str(i % 32)}],
+        'terms': [_term('yrTerm1', i), _term('yrTerm3', i)],
+    } for i in range(ntypes)]}
+
+
+def test_index_against_scan():
+    fulllist = _pricelist(320)
+    idx = ap.PriceIndex(fulllist)
+
+    for t in ('x0.large', 'x17.large', 'x319.large', 'nope.large'):
+        assert ap.instance_price(idx, t) == ap.instance_price(fulllist, t)
+        assert ap.get_instance_attrs(idx, t) == \
+            ap.get_instance_attrs(fulllist, t)
+        assert ap.get_instance_prices(idx, t) == \
+            ap.get_instance_prices(fulllist, t)
+
+
+@pytest.mark.skipif(
+    not os.environ.get('AWSTOOLS_BENCH'),
+    reason = 'benchmark, set AWSTOOLS_BENCH to run it'
+)
+def test_index_benchmark():
+    fulllist = _pricelist(320)
+    fleet = ['x{0}.large'.format(i * 7 % 320) for i in range(10000)]
+
+    start = time.time()
+    scanned = [ap.instance_price(fulllist, t) for t in fleet]
+    scan = time.time() - start
+
+    start = time.time()
+    idx = ap.PriceIndex(fulllist)
+    indexed = [ap.instance_price(idx, t) for t in fleet]
+    index = time.time() - start
+
+    assert indexed == scanned
+    # an order of magnitude is expected, keep a margin for slow machines
+    assert index * 3 < scan, (index, scan)
+
+
+def _old_regions(text):
+    # regions as get_regions parsed them before iter_regions
+    jregex = re.search(r'.+config:(\{(.+)\})(\}\);|,vers:0\.0.+)', text)
+    s = re.sub(r'([a-zA-Z0-9_-]+):', r'"\1":', jregex.group(1))
+    return json.loads(s)['regions']
+
+
+REGIONS = (
+    '{region:"us-east-1",instanceTypes:[{type:"generalCurrentGen",'
+    'sizes:[{size:"t2.micro",vCPU:"1",ECU:"variable",memoryGiB:"1",'
+    'valueColumns:[{name:"linux",prices:{USD:"0.013"}}]}]}]},'
+    '{region:"eu-west-1",instanceTypes:[{type:"t2.micro",terms:[{'
+    'term:"yrTerm1",onDemandHourly:[{purchaseOption:"ODHourly",'
+    'prices:{USD:"0.014"}}],purchaseOptions:[{purchaseOption:"noUpfront",'
+    'valueColumns:[{name:"effectiveHourly",rate:"perhr",'
+    'prices:{USD:"0.01"}},{name:"upfront",prices:{USD:"0"}}]}]}]}]},'
+    '{region:"ap-south-1",instanceTypes:[]}'
+)
+# on demand models start with their version, reserved ones end with it
+LAYOUTS = {
+    'od': 'callback({vers=0.01,config:{rate:"perhr",valueColumns:["vCPU",'
+          '"ECU"],currencies:["USD"],regions:[' + REGIONS + ']}});',
+    'ri-v2': '/* comment */callback({config:{currencies:["USD"],regions:['
+             + REGIONS + ']},vers:0.01});',
+}
+
+
+@pytest.mark.parametrize('layout', sorted(LAYOUTS))
+def test_iter_regions_matches_regex(layout):
+    text = LAYOUTS[layout]
+    regions = list(ap.iter_regions(text))
+
+    assert regions == _old_regions(text)
+    assert [r['region'] for r in regions] == \
+        ['us-east-1', 'eu-west-1', 'ap-south-1']
+    assert ap.model_version(text) == '0.01'
+
+
+def test_iter_regions_fallbacks():
+    # quoting keys breaks those strings, so is single quoting for json
+    text = (
+        "callback({vers:0.01,config:{regions:["
+        "{region:\"us-east-1\",note:\"a, b: c\",sizes:[1,2.5,true,null]},"
+        "{region:'eu-west-1',note:'it\\'s',empty:{}}"
+        "]}});"
+    )
+    assert list(ap.iter_regions(text)) == [
+        {
+            'region': 'us-east-1', 'note': 'a, b: c',
+            'sizes': [1, 2.5, True, None],
+        },
+        {'region': 'eu-west-1', 'note': "it's", 'empty': {}},
+    ]
+
+
+def test_lookup_stops_at_region(catalog, monkeypatch):
+    c = catalog()
+    # anything after the requested region is never parsed
+    text = LAYOUTS['od'].replace(
+        '{region:"ap-south-1"', '{region:"ap-south-1",broken:[}'
+    )
+    monkeypatch.setattr(ap, 'get_model', lambda resource, restype: text)
+
+    found = ap.get_all_instances('eu-west-1', 'ec2', 'linux-od')
+
+    assert found == _old_regions(LAYOUTS['od'])[1]
+    assert sorted(c.data) == sorted(
+        ap._catalog_key('ec2', 'linux-od', r)
+        for r in ('us-east-1', 'eu-west-1')
+    )
+    with pytest.raises(ValueError):
+        list(ap.iter_regions(text))
@@ -0,0 +1,47 @@
+import os
+
+from mods.cache import DiskCache
+
+
+def test_sharded_entries_are_independent(tmpdir):
+    path = str(tmpdir.join('pages'))
+    cache = DiskCache('pages', path = path, sharded = True)
+    cache.set('http://a', 'x' * 100000, etag = '"a"')
+    shard = [os.path.join(path, f) for f in os.listdir(path)]
+    before = os.stat(shard[0]).st_mtime, os.stat(shard[0]).st_ino
+
+    cache.set('http://b', 'y')
+
+    # storing b did not rewrite a
+    assert (os.stat(shard[0]).st_mtime, os.stat(shard[0]).st_ino) == before
+    assert len(os.listdir(path)) == 2
+
+    other = DiskCache('pages', path = path, sharded = True)
+    assert other.get('http://b') == 'y'
+    # only the requested entry was read
+    assert list(other.data) == ['http://b']
+    assert other.entry('http://a')['etag'] == '"a"'
+    assert other.get('http://c') is None
+
+
+def test_single_file(tmpdir):
+    path = str(tmpdir.join('amis.json'))
+    cache = DiskCache('amis', path = path)
+    cache.setmany({'a': 1, 'b': 2})
+    assert DiskCache('amis', path = path).get('b') == 2
+    assert DiskCache('amis', path = path).get('a', ttl = -1) is None
+
+
+def test_directory_created_on_first_write(cachehome):
+    single = DiskCache('amis')
+    sharded = DiskCache('pages', sharded = True)
+    assert single.get('a') is None
+    assert sharded.get('http://a') is None
+    assert not cachehome.check()
+
+    sharded.set('http://a', 'x')
+    single.set('a', 1)
+
+    assert sorted(os.listdir(str(cachehome.join('awstools')))) == \
+        ['amis.json', 'pages']
+    assert DiskCache('amis').get('a') == 1
@@ -0,0 +1,161 @@
+import threading
+
+import pytest
+
+import conftest
+import mods.session
+
+
+def test_topology_on_fresh_context(load_ec2):
+    ec2 = load_ec2('lsyaml')
+    ctx = ec2.Context('ireland')
+    res = []
+
+    t = threading.Thread(target = lambda: res.append(ctx.topology))
+    t.daemon = True
+    t.start()
+    t.join(5)
+
+    assert not t.is_alive(), 'Context.topology deadlocked'
+    assert res[0].aws is ctx.ec2
+    assert ctx.topology is res[0]
+
+
+def test_tag_volumes_reports_missing(load_ec2, monkeypatch):
+    ec2 = load_ec2('create')
+    ctx = ec2.Context('ireland')
+    tagged = []
+
+    def _describe(profile, Filters):
+        return {'Reservations': [{'Instances': [{
+            'InstanceId': iid,
+            'BlockDeviceMappings': [{
+                'DeviceName': '/dev/xvd{0}'.format(d),
+                'Ebs': {'VolumeId': 'vol-{0}{1}'.format(iid, d)}
+            } for d in 'ab'],
+        } for iid in Filters[0]['Values'] if iid != 'i-lost']}]}
+
+    conftest.replies[('ec2', 'describe_instances')] = _describe
+    conftest.replies[('ec2', 'create_tags')] = \
+        lambda profile, Resources, Tags: tagged.append((Resources, Tags))
+    monkeypatch.setattr(
+        ec2, 'waiter', lambda f, **kw: mods.session.waiter(
+            f, timeout = 0.2, base = 0.01, **kw
+        )
+    )
+
+    instances = [
+        {'awsid': 'i-1', 'name': 'foo-www-1'},
+        {'awsid': 'i-lost', 'name': 'foo-www-2'},
+    ]
+    persisted = {}
+    with pytest.raises(mods.session.WaiterTimeout) as e:
+        ec2._tag_volumes(
+            ctx, instances,
+            lambda i, state: persisted.setdefault(i['name'], state)
+        )
+
+    assert 'foo-www-2' in str(e.value)
+    assert persisted == {'foo-www-1': {'awsvolumes': {
+        'xvda': 'vol-i-1a', 'xvdb': 'vol-i-1b'
+    }}}
+    assert sorted(r[0] for r, t in tagged) == ['vol-i-1a', 'vol-i-1b']
+
+
+DESCRIPTION = """
+ireland:
+- foo-net-aza:
+  - {type: t2.micro, customer: foo, name: foo-www-1, ipaddr: 10.1.1.10,
+     elb: {scheme: internal, sg: []}}
+- foo-net-azb:
+  - {type: t2.micro, customer: foo, name: foo-www-2, ipaddr: 10.1.2.10,
+     elb: {scheme: internal, sg: []}}
+- bar-net-aza:
+  - {type: t2.micro, customer: bar, name: bar-www-1, ipaddr: 10.2.1.10}
+"""
+
+
+def test_create_dependencies(load_ec2, monkeypatch, tmpdir):
+    ec2 = load_ec2('create', str(tmpdir.join('infra.yaml')))
+    tmpdir.join('infra.yaml').write(DESCRIPTION)
+    conftest.replies[('ec2', 'describe_instances')] = \
+        lambda profile, Filters: {'Reservations': []}
+    graphs = []
+
+    class Recorder(ec2.Scheduler):
+        def run(self):
+            graphs.append(dict(
+                (k, sorted(self.nodes[k]['deps'])) for k in self.order
+            ))
+            return {}
+
+    monkeypatch.setattr(ec2, 'Scheduler', Recorder)
+    ec2.create()
+
+    deps = graphs[0]
+    assert deps['ireland/subnet/foo-net-aza'] == []
+    # same route table, created by the first subnet job
+    assert deps['ireland/subnet/foo-net-azb'] == ['ireland/subnet/foo-net-aza']
+    # another customer does not wait for foo
+    assert deps['ireland/subnet/bar-net-aza'] == []
+    assert deps['ireland/instance/bar-www-1'] == ['ireland/subnet/bar-net-aza']
+    assert deps['ireland/instance/foo-www-2'] == ['ireland/subnet/foo-net-azb']
+    assert deps['ireland/elb/foo-www-2'] == [
+        'ireland/elb/foo-www-1', 'ireland/instance/foo-www-2',
+        'ireland/subnet/foo-net-aza', 'ireland/subnet/foo-net-azb',
+    ]
+
+
+def test_lsyaml_offline(load_ec2, monkeypatch, tmpdir):
+    tmpdir.join('infra.yaml').write(DESCRIPTION)
+    ec2 = load_ec2('lsyaml', str(tmpdir.join('infra.yaml')))
+    monkeypatch.chdir(str(tmpdir))
+    regions = []
+
+    def _prices(region, resource, restype):
+        regions.append(region)
+        return {'instanceTypes': []}
+
+    monkeypatch.setattr(ec2.ap, 'get_all_instances', _prices)
+    ec2.lsyaml()
+
+    assert regions == ['eu-west-1']
+    # the region comes from the local profile, nothing reaches AWS
+    assert [c for c in conftest.calls if c[0] != 'session'] == []
+    assert tmpdir.join('prices.csv').check()
+
+
+def test_ls_flushes_every_page(load_ec2, monkeypatch):
+    ec2 = load_ec2('ls')
+    out = []
+
+    class Stdout(object):
+        def write(self, s):
+            out.append(s)
+
+        def flush(self):
+            out.append(None)
+
+    def _instance(n):
+        return {
+            'InstanceId': 'i-{0}'.format(n), 'InstanceType': 't2.micro',
+            'State': {'Name': 'running'},
+            'Placement': {'AvailabilityZone': 'eu-west-1a'},
+            'Tags': [{'Key': 'Name', 'Value': 'www-{0}'.format(n)}],
+        }
+
+    conftest.replies[('ec2', 'describe_instances')] = \
+        lambda profile, Filters: [
+            {'Reservations': [{'Instances': [_instance(0), _instance(1)]}]},
+            {'Reservations': [{'Instances': [_instance(2)]}]},
+        ]
+    monkeypatch.setattr(ec2.sys, 'stdout', Stdout())
+    ec2.ls()
+
+    lines = ''.join(s or '|' for s in out).split('\n')
+    assert lines == [
+        'i-0 www-0 (t2.micro) - [running]',
+        'i-1 www-1 (t2.micro) - [running]',
+        '|i-2 www-2 (t2.micro) - [running]',
+        '|',
+    ]
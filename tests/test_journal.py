@@ -0,0 +1,98 @@
+import os
+import threading
+
+import yaml
+
+from mods.journal import Journal
+
+
+def _description(n):
+    return {'ireland': [{'net-aza': [
+        {'name': 'foo-www-{0}'.format(i), 'type': 't2.micro'}
+        for i in range(n)
+    ]}]}
+
+
+def test_compaction_is_geometric(tmpdir, monkeypatch):
+    yf = str(tmpdir.join('infra.yaml'))
+    y = _description(2000)
+    with open(yf, 'w') as f:
+        yaml.dump(y, f, default_flow_style=False)
+
+    journal = Journal(yf, y, minsize = 1024)
+    written = []
+    dump = yaml.safe_dump
+    def _dump(data, f, **kwargs):
+        written.append(1)
+        return dump(data, f, **kwargs)
+    monkeypatch.setattr(yaml, 'safe_dump', _dump)
+
+    for instance in y['ireland'][0]['net-aza']:
+        journal.record(instance, {'awsid': 'i-{0}'.format(instance['name'])})
+    journal.close()
+
+    # the description doubles at most, it is not rewritten every n records
+    assert len(written) <= 4
+    with open(yf) as f:
+        saved = yaml.safe_load(f)
+    assert all(
+        i['awsid'] == 'i-{0}'.format(i['name'])
+        for i in saved['ireland'][0]['net-aza']
+    )
+    assert not os.path.exists('{0}.journal'.format(yf))
+
+
+def test_replay_rotated_and_current(tmpdir):
+    yf = str(tmpdir.join('infra.yaml'))
+    y = _description(2)
+    with open(yf, 'w') as f:
+        yaml.dump(y, f, default_flow_style=False)
+    with open('{0}.journal.1'.format(yf), 'w') as f:
+        f.write('{"key": "ireland/foo-www-0", "state": {"awsid": "i-0"}}\n')
+    with open('{0}.journal'.format(yf), 'w') as f:
+        f.write('{"key": "ireland/foo-www-1", "state": {"awsid": "i-1"}}\n')
+        f.write('{"key": "ireland/foo-w')
+
+    y = yaml.safe_load(open(yf))
+    journal = Journal(yf, y)
+    journal.close()
+
+    saved = yaml.safe_load(open(yf))['ireland'][0]['net-aza']
+    assert [i.get('awsid') for i in saved] == ['i-0', 'i-1']
+    assert not os.path.exists('{0}.journal.1'.format(yf))
+
+
+def test_records_while_compacting(tmpdir):
+    yf = str(tmpdir.join('infra.yaml'))
+    y = _description(400)
+    journal = Journal(yf, y, minsize = 256)
+    instances = y['ireland'][0]['net-aza']
+
+    def _work(part):
+        for instance in part:
+            journal.record(instance, {'awsid': instance['name']})
+
+    threads = [
+        threading.Thread(target = _work, args = (instances[i::4],))
+        for i in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    journal.close()
+
+    saved = yaml.safe_load(open(yf))['ireland'][0]['net-aza']
+    assert all(i['awsid'] == i['name'] for i in saved)
+
+
+def test_nothing_recorded_keeps_description(tmpdir):
+    yf = tmpdir.join('infra.yaml')
+    yf.write('# fleet of foo\nireland:\n- net-aza:\n  - {name: foo-www-0}\n')
+    before = yf.read()
+
+    journal = Journal(str(yf), yaml.safe_load(before))
+    journal.close()
+
+    assert yf.read() == before
+    assert not os.path.exists('{0}.journal'.format(yf))
@@ -0,0 +1,42 @@
+import conftest
+
+
+def _instances(profile, Filters):
+    n = {'default': 3, 'prod': 3, 'other': 2}[profile]
+    return {'Reservations': [{'Instances': [{
+        'InstanceId': 'i-{0}{1}'.format(profile, i),
+        'InstanceType': 't2.micro',
+        'State': {'Name': 'running'},
+        'Placement': {'AvailabilityZone': 'eu-west-1a'},
+        'Tags': [{'Key': 'Name', 'Value': 'foo-{0}'.format(i)}],
+    } for i in range(n)]}]}
+
+
+def _identity(profile):
+    return {'Account': {'default': '1', 'prod': '1', 'other': '2'}[profile]}
+
+
+def test_lsec2_dedupes_accounts(load_ec2, monkeypatch, capsys, tmpdir):
+    ec2 = load_ec2('lsec2', 'foo-*', 'default', 'prod', 'other', 'noregion')
+    conftest.replies[('ec2', 'describe_instances')] = _instances
+    conftest.replies[('sts', 'get_caller_identity')] = _identity
+    conftest.regions['noregion'] = None
+
+    fetched = []
+    def _regions_instances(regions, resource, restype):
+        fetched.append(regions)
+        return {}
+    monkeypatch.setattr(ec2.ap, 'get_regions_instances', _regions_instances)
+    monkeypatch.chdir(str(tmpdir))
+
+    ec2.lsec2()
+
+    out = capsys.readouterr()[0]
+    assert 'skipping profile noregion' in out
+    # default and prod are the same account, only counted once
+    assert 't2.micro: 5' in out
+    assert fetched == [['eu-west-1']]
+    listed = set(
+        c[1] for c in conftest.calls if c[-1] == 'describe_instances'
+    )
+    assert listed == set(['other', 'prod'])
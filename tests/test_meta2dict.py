@@ -0,0 +1,206 @@
+'''meta2dict tests, against a local fake metadata service
+'''
+
+import os
+import sys
+import json
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'platforms', 'scripts'
+))
+
+import meta2dict
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+TREE = {
+    'latest/meta-data/': 'ami-id\ninstance-id\nplacement/\niam/',
+    'latest/meta-data/ami-id': 'ami-123',
+    'latest/meta-data/instance-id': 'i-abc',
+    'latest/meta-data/placement/': 'availability-zone\nregion',
+    'latest/meta-data/placement/availability-zone': 'eu-west-1a',
+    'latest/meta-data/placement/region': 'eu-west-1',
+    'latest/meta-data/iam/': 'info\nsecurity-credentials/',
+    'latest/meta-data/iam/info': json.dumps({'Code': 'Success'}),
+    'latest/meta-data/iam/security-credentials/': 'role',
+    'latest/meta-data/iam/security-credentials/role': json.dumps(
+        {'AccessKeyId': 'x'}
+    ),
+    'latest/dynamic/': 'instance-identity/\n',
+    'latest/dynamic/instance-identity/': 'document\nsignature',
+    'latest/dynamic/instance-identity/document': json.dumps(
+        {'region': 'eu-west-1'}
+    ),
+    'latest/dynamic/instance-identity/signature': 'abc==',
+    'latest/user-data/': 'hello',
+}
+
+EXPECTED = {
+    'meta-data': {
+        'ami-id': 'ami-123',
+        'instance-id': 'i-abc',
+        'placement': {
+            'availability-zone': 'eu-west-1a',
+            'region': 'eu-west-1',
+        },
+        'iam': {
+            'info': {'Code': 'Success'},
+            'security-credentials': {'role': {'AccessKeyId': 'x'}},
+        },
+    },
+    'dynamic': {
+        'instance-identity': {
+            'document': {'region': 'eu-west-1'},
+            'signature': 'abc==',
+        },
+    },
+    'user-data': {'hello': None},
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    token = 'TOKEN'
+    gets = []
+    # token header of every GET, None when missing
+    tokens = []
+    # status to answer once, by path
+    errors = {}
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body = ''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def do_PUT(self):
+        if Handler.token is None:
+            return self._reply(404)
+        self._reply(200, Handler.token)
+
+    def do_GET(self):
+        Handler.gets.append(self.path)
+        Handler.tokens.append(self.headers.get('X-aws-ec2-metadata-token'))
+        if Handler.token is not None and \
+            self.headers.get('X-aws-ec2-metadata-token') != Handler.token:
+            return self._reply(401)
+        path = self.path.lstrip('/')
+        if path in Handler.errors:
+            return self._reply(Handler.errors.pop(path), 'Service Unavailable')
+        if path in TREE:
+            return self._reply(200, TREE[path])
+        self._reply(404)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def imds(monkeypatch):
+    '''Fake metadata service, requiring an IMDSv2 token by default
+    '''
+    server = Server(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target = server.serve_forever)
+    t.daemon = True
+    t.start()
+    monkeypatch.setattr(
+        meta2dict, 'METAHOST', 'http://127.0.0.1:{0}'.format(server.server_port)
+    )
+    monkeypatch.setattr(Handler, 'token', 'TOKEN')
+    del Handler.gets[:]
+    del Handler.tokens[:]
+    Handler.errors.clear()
+    yield Handler
+    server.shutdown()
+    server.server_close()
+
+
+def test_load_without_snapshot(imds):
+    assert meta2dict.load(lazy = False, snapshot = None) == EXPECTED
+
+
+def test_token_sent(imds):
+    assert meta2dict.load(lazy = False, snapshot = None) == EXPECTED
+    assert imds.tokens and set(imds.tokens) == set(['TOKEN'])
+
+
+def test_imdsv1_fallback(imds):
+    imds.token = None
+    assert meta2dict.load(lazy = False, snapshot = None) == EXPECTED
+    assert set(imds.tokens) == set([None])
+
+
+def test_lazy_lookup_cost(imds):
+    md = meta2dict.load(snapshot = None)
+    assert imds.gets == []
+
+    assert md['meta-data']['instance-id'] == 'i-abc'
+    # the meta-data listing, then the value itself
+    assert imds.gets == [
+        '/latest/meta-data/', '/latest/meta-data/instance-id'
+    ]
+
+
+def test_snapshot_loose_mode_ignored(imds, tmpdir):
+    d = tmpdir.mkdir('snap')
+    d.chmod(0o700)
+    path = d.join('meta2dict.json')
+    path.write(json.dumps({
+        'latest/meta-data/instance-id': [0, 200, 'i-poisoned']
+    }))
+    path.chmod(0o644)
+
+    md = meta2dict.load(snapshot = str(path))
+    assert md['meta-data']['instance-id'] == 'i-abc'
+
+
+def test_snapshot_in_shared_directory_disabled(imds, tmpdir):
+    d = tmpdir.mkdir('shared')
+    d.chmod(0o777)
+    path = d.join('meta2dict.json')
+
+    assert meta2dict.load(lazy = False, snapshot = str(path)) == EXPECTED
+    assert not path.check()
+    assert not d.join('meta2dict.json.lock').check()
+
+
+def test_snapshot_unusable_path(imds, tmpdir):
+    path = tmpdir.join('missing', 'deeper', 'meta2dict.json')
+    assert meta2dict.load(lazy = False, snapshot = str(path)) == EXPECTED
+
+
+def test_snapshot_shared(imds, tmpdir):
+    path = str(tmpdir.mkdir('own').join('meta2dict.json'))
+    meta2dict.load(lazy = False, snapshot = path)
+    fetched = len(imds.gets)
+
+    assert meta2dict.load(lazy = False, snapshot = path) == EXPECTED
+    # credentials, listing and role, are never kept in the snapshot
+    assert len(imds.gets) == fetched + 2
+    assert 'x' not in open(path).read()
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+
+def test_snapshot_errors_not_shared(imds, tmpdir):
+    path = str(tmpdir.mkdir('own').join('meta2dict.json'))
+    imds.errors['latest/meta-data/instance-id'] = 503
+
+    md = meta2dict.load(snapshot = path)
+    assert md['meta-data']['instance-id'] == 'Service Unavailable'
+
+    # another process gets the real value, not the throttled reply
+    md = meta2dict.load(snapshot = path)
+    assert md['meta-data']['instance-id'] == 'i-abc'
+    assert imds.gets[-1] == '/latest/meta-data/instance-id'
@@ -0,0 +1,64 @@
+import sys
+import time
+import threading
+
+import pytest
+
+from mods.scheduler import Scheduler
+
+
+def test_failure_only_skips_dependents(capsys):
+    ran = []
+    sched = Scheduler(2)
+    sched.add('net-a', lambda: sys.exit(1))
+    sched.add('net-b', ran.append, ('net-b',))
+    sched.add('vm-a', ran.append, ('vm-a',), deps = ['net-a'])
+    sched.add('vm-b', ran.append, ('vm-b',), deps = ['net-b'])
+
+    failed = sched.run()
+
+    assert sorted(failed) == ['net-a', 'vm-a']
+    assert sorted(ran) == ['net-b', 'vm-b']
+    out = capsys.readouterr()[0]
+    assert 'net-a aborted' in out
+    assert 'Traceback' not in out
+
+
+def test_interrupt_stops_the_run():
+    ran = []
+
+    def _job(n):
+        if n == 0:
+            raise KeyboardInterrupt()
+        time.sleep(0.05)
+        ran.append(n)
+
+    sched = Scheduler(2)
+    for n in range(20):
+        sched.add('vm-{0}'.format(n), _job, (n,))
+
+    with pytest.raises(KeyboardInterrupt):
+        sched.run()
+
+    # only the jobs already handed to a worker ran
+    assert len(ran) < 4
+
+
+def test_workers_bound_submitted_jobs():
+    running = [0, 0]
+    lock = threading.Lock()
+
+    def _job():
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+
+    sched = Scheduler(3)
+    for n in range(12):
+        sched.add('vm-{0}'.format(n), _job)
+
+    assert sched.run() == {}
+    assert running[0] == 0 and running[1] <= 3
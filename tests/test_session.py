@@ -0,0 +1,277 @@
+import io
+import gzip
+import email
+import base64
+import threading
+
+import pytest
+
+import conftest
+import mods.session
+from mods.cache import DiskCache
+from mods.session import Aws, DnsBatch, MAXRRCHANGES, MAXRRCHARS
+
+
+@pytest.fixture
+def amicache(monkeypatch, tmpdir):
+    cache = DiskCache('amis', path = str(tmpdir.join('amis.json')))
+    monkeypatch.setattr(mods.session, 'amicache', cache)
+    return cache
+
+
+def test_getamis_empty_not_cached(aws_calls, amicache):
+    images = []
+    conftest.replies[('ec2', 'describe_images')] = \
+        lambda profile, Filters: {'Images': list(images)}
+    ec2 = Aws('ireland', 'ec2')
+
+    with pytest.raises(ValueError):
+        ec2.getami('debian-*')
+
+    images.append({'ImageId': 'ami-1', 'CreationDate': '2017-01-01'})
+    assert ec2.getami('debian-*') == 'ami-1'
+    assert ec2.getami('debian-*') == 'ami-1'
+    lookups = [c for c in aws_calls if c[-1] == 'describe_images']
+    assert len(lookups) == 2
+
+
+def test_getamis_does_not_block_nametags(aws_calls, amicache):
+    started = threading.Event()
+    release = threading.Event()
+
+    def _images(profile, Filters):
+        started.set()
+        release.wait(5)
+        return {'Images': [{'ImageId': 'ami-1', 'CreationDate': '1'}]}
+
+    conftest.replies[('ec2', 'describe_images')] = _images
+    conftest.replies[('ec2', 'describe_subnets')] = \
+        lambda profile, Filters: {'Subnets': [
+            {'SubnetId': 'subnet-1', 'Tags': [{'Key': 'Name', 'Value': 'a'}]}
+        ]}
+    ec2 = Aws('ireland', 'ec2')
+
+    t = threading.Thread(target = ec2.getami, args = ('debian-*',))
+    t.start()
+    try:
+        assert started.wait(5)
+        # the AMI lookup is in flight, name tags are still available
+        assert ec2.get_id_from_nametag('subnets', 'a') == 'subnet-1'
+    finally:
+        release.set()
+        t.join()
+
+
+def test_resources_per_thread(aws_calls):
+    ec2 = Aws('ireland', 'ec2')
+    other = Aws('ireland', 'ec2')
+    mine = ec2.resource
+    theirs = []
+    t = threading.Thread(target = lambda: theirs.append(other.resource))
+    t.start()
+    t.join()
+
+    assert ec2.resource is mine
+    assert other.resource is mine
+    assert theirs[0] is not mine
+    assert ec2.client is other.client
+    sessions = [c for c in aws_calls if c[0] == 'session']
+    assert sessions == [('session', 'ireland')]
+
+
+def test_resource_errors(aws_calls, monkeypatch):
+    def _missing(self, service):
+        raise conftest.ResourceNotExistsError(service)
+
+    monkeypatch.setattr(conftest.FakeSession, 'resource', _missing)
+    with pytest.raises(AttributeError):
+        Aws('ireland', 'route53').resource
+
+    def _broken(self, service):
+        raise ValueError('bad credentials')
+
+    monkeypatch.setattr(conftest.FakeSession, 'resource', _broken)
+    with pytest.raises(ValueError):
+        Aws('ireland', 'sqs').resource
+
+
+@pytest.fixture
+def route53(aws_calls):
+    '''route53 stand-in knowing foo.com and bar.com, returns the change
+    batches submitted, as (zone id, changes) tuples
+    '''
+    submitted = []
+
+    def _zones(profile, DNSName, MaxItems):
+        # like AWS, the next zone in lexicographic order for an unknown one
+        if DNSName not in ('foo.com', 'bar.com'):
+            return {'HostedZones': [
+                {'Id': '/hostedzone/other', 'Name': 'zzz.com.'}
+            ]}
+        return {'HostedZones': [{
+            'Id': '/hostedzone/{0}'.format(DNSName),
+            'Name': '{0}.'.format(DNSName),
+        }]}
+
+    def _change(profile, HostedZoneId, ChangeBatch):
+        submitted.append((HostedZoneId, ChangeBatch['Changes']))
+        return {'ChangeInfo': {'Id': 'change-{0}'.format(len(submitted))}}
+
+    conftest.replies[('route53', 'list_hosted_zones_by_name')] = _zones
+    conftest.replies[('route53', 'change_resource_record_sets')] = _change
+    return submitted
+
+
+def _record(name, zone = 'foo.com', target = '10.0.0.1'):
+    return {
+        'zone': zone, 'rectype': 'A', 'name': name, 'ttl': 300,
+        'target': target,
+    }
+
+
+def test_dnsbatch_per_zone(route53, aws_calls):
+    batch = DnsBatch(Aws('ireland', 'route53'))
+    batch.add('CREATE', _record('a', 'bar.com'))
+    batch.add('CREATE', _record('b'))
+    batch.add('DELETE', _record('c', 'bar.com'))
+
+    assert batch.flush() == ['change-1', 'change-2']
+    # zones in the order they were first seen, each looked up once
+    assert [(z, [c['ResourceRecordSet']['Name'] for c in changes])
+            for z, changes in route53] == [
+        ('/hostedzone/bar.com', ['a.bar.com.', 'c.bar.com.']),
+        ('/hostedzone/foo.com', ['b.foo.com.']),
+    ]
+    lookups = [c for c in aws_calls if c[-1] == 'list_hosted_zones_by_name']
+    assert len(lookups) == 2
+    assert batch.flush() == []
+
+
+def test_dnsbatch_upsert_counts_double(route53):
+    batch = DnsBatch(Aws('ireland', 'route53'))
+    for i in range(MAXRRCHANGES):
+        batch.add('CREATE', _record('c{0}'.format(i)))
+    batch.flush()
+    for i in range(MAXRRCHANGES // 2 + 1):
+        batch.add('UPSERT', _record('u{0}'.format(i)))
+    batch.flush()
+
+    assert [len(changes) for z, changes in route53] == \
+        [MAXRRCHANGES, MAXRRCHANGES // 2, 1]
+
+
+def test_dnsbatch_chars_limit(route53):
+    batch = DnsBatch(Aws('ireland', 'route53'))
+    value = 'x' * 200
+    for i in range(MAXRRCHARS // len(value) + 1):
+        batch.add('CREATE', _record('t{0}'.format(i), target = value))
+    batch.flush()
+
+    assert [len(changes) for z, changes in route53] == \
+        [MAXRRCHARS // len(value), 1]
+
+
+def test_dnsbatch_alias_records(route53):
+    batch = DnsBatch(Aws('ireland', 'route53'))
+    for i in range(MAXRRCHANGES):
+        rec = _record('elb{0}'.format(i), target = 'Z32O12XQLNTSW2')
+        rec['dnsname'] = 'elb-{0}.eu-west-1.elb.amazonaws.com'.format(i) * 10
+        batch.add('CREATE', rec)
+    batch.flush()
+
+    # aliases have no value, they count as a single change and no char
+    assert [len(changes) for z, changes in route53] == [MAXRRCHANGES]
+    rrset = route53[0][1][0]['ResourceRecordSet']
+    assert 'ResourceRecords' not in rrset
+    assert rrset['AliasTarget']['HostedZoneId'] == 'Z32O12XQLNTSW2'
+
+
+def test_dnsbatch_unknown_zone(route53):
+    batch = DnsBatch(Aws('ireland', 'route53'))
+    batch.add('CREATE', _record('a', 'nope.com'))
+
+    with pytest.raises(ValueError):
+        batch.flush()
+    assert route53 == []
+
+
+@pytest.mark.parametrize('text, args', [
+    ('plain', ()),
+    ('a {} b {:>5} {{x}} }}{{', ('p', 'q')),
+    ('{1}{0!r:>8}{1!s}', ('p', 'q')),
+    ('{0[1]}-{1.real:+}', ('pq', 3)),
+    ('{:{}}|{}', ('x', 4, 'z')),
+    ('{0:{1}}|{2}', ('x', 4, 'z')),
+    ('{0} {}', ('x', 'y')),
+    ('{} {0}', ('x', 'y')),
+    ('{2}', ('x',)),
+])
+def test_template_like_format(text, args):
+    try:
+        expected = text.format(*args)
+    except (ValueError, IndexError) as e:
+        with pytest.raises(type(e)):
+            mods.session.Template(text).render(*args)
+    else:
+        assert mods.session.Template(text).render(*args) == expected
+
+
+@pytest.fixture
+def userdata(monkeypatch, tmpdir):
+    '''Writes userdata files, returns their names
+    '''
+    tmpdir.mkdir('userdata')
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setattr(mods.session, '_templates', {})
+
+    def _write(**files):
+        for name in files:
+            tmpdir.join('userdata', name).write(files[name])
+        return sorted(files)
+    return _write
+
+
+def test_userdata_formats(aws_calls, userdata):
+    files = userdata(**{
+        '1-base.sh': '#!/bin/sh\necho {} {}\n',
+        '2-more.sh': 'echo more\n',
+        '3-cloud.yaml': '#cloud-config\nbootcmd: [echo {}]\n',
+    })
+    ec2 = Aws('ireland', 'ec2')
+    kw = {'userdata': files, 'name': 'FOO-1', 'netblock': '10.0.0.0/24'}
+
+    assert ec2.mkuserdata(**kw) == '#!/bin/sh\necho ireland foo-1\n' \
+        'echo more\n#cloud-config\nbootcmd: [echo 10.0.0.0/24]\n'
+
+    def _parts(data):
+        return [
+            (p.get_content_type(),
+             p.get_payload(decode = True).decode('utf-8'))
+            for p in email.message_from_string(data).get_payload()
+        ]
+
+    # files without a header belong to the previous part, and {} numbering
+    # goes on across parts as when files are merged
+    parts = [
+        ('text/x-shellscript', '#!/bin/sh\necho ireland foo-1\necho more\n'),
+        ('text/cloud-config', '#cloud-config\nbootcmd: [echo 10.0.0.0/24]\n'),
+    ]
+    assert _parts(ec2.mkuserdata(fmt = 'multipart', **kw)) == parts
+
+    packed = ec2.mkuserdata(b64 = True, fmt = 'gzip', **kw)
+    data = gzip.GzipFile(fileobj = io.BytesIO(base64.b64decode(packed)))
+    assert _parts(data.read().decode('utf-8')) == parts
+
+
+def test_userdata_size_limit(aws_calls, userdata):
+    files = userdata(**{'big.sh': '#!/bin/sh\n' + 'echo {0}\n' * 2000})
+    ec2 = Aws('ireland', 'ec2')
+
+    with pytest.raises(ValueError) as e:
+        ec2.mkuserdata(userdata = files, name = 'foo-1')
+    assert 'try the gzip format' in str(e.value)
+    with pytest.raises(ValueError):
+        ec2.mkuserdata(userdata = files, name = 'foo-1', fmt = 'multipart')
+
+    packed = ec2.mkuserdata(userdata = files, name = 'foo-1', fmt = 'gzip')
+    assert len(packed) <= mods.session.MAXUSERDATA